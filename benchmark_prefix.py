@@ -0,0 +1,39 @@
+"""
+Times prefix resolution for ordinary (non-command) messages,
+comparing the old when_mentioned_or list against base.get_prefix.
+Run with python benchmark_prefix.py
+"""
+import itertools
+import timeit
+import types
+from discord.ext import commands
+from src.base import get_prefix
+
+NUM_RUNS = 100000
+
+bot = types.SimpleNamespace(user=types.SimpleNamespace(id=203285581004931072))
+message = types.SimpleNamespace(
+    content="lol did anyone else see that, it was so good")
+
+prefix_combinations = itertools.product('mMnN', 'bB', '.!', [' ', ''])
+prefixes = [''.join(r) for r in prefix_combinations]
+old_get_prefix = commands.when_mentioned_or(*prefixes)
+
+
+def resolve(prefix_func):
+    # Mirrors what Bot.get_context does with the command_prefix result
+    prefix = prefix_func(bot, message)
+    if isinstance(prefix, str):
+        return message.content.startswith(prefix)
+    return message.content.startswith(tuple(prefix))
+
+
+def main():
+    for name, prefix_func in [("when_mentioned_or", old_get_prefix),
+                              ("get_prefix", get_prefix)]:
+        seconds = timeit.timeit(lambda: resolve(prefix_func), number=NUM_RUNS)
+        print(f"{name}: {seconds / NUM_RUNS * 1e6:.2f} us per message")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,8 @@
 Module containing the majority of the basic commands makubot can execute.
 """
 import sys
+import re
 import logging
-import itertools
 import discord
 from discord.ext import commands
 from psycopg2.extras import RealDictCursor
@@ -12,6 +12,58 @@ logger = logging.getLogger()
 
 SUPPORT_SERVER_ID = 704113879919099914
 
+# Matches mb., mb!, nb., Mb! etc with an optional trailing space,
+# or a mention of a user, which might be the bot
+PREFIX_PATTERN = re.compile(r"[mMnN][bB][.!] ?|<@!?(\d+)> ")
+
+
+def get_prefix(bot, message):
+    """
+    Resolves the prefix with one precompiled match rather than trying
+    every combination with startswith. Messages without a prefix,
+    which is most of them, get an empty list.
+    """
+    prefix_match = PREFIX_PATTERN.match(message.content)
+    if prefix_match is None:
+        return []
+    mentioned_id = prefix_match.group(1)
+    if mentioned_id is not None and int(mentioned_id) != bot.user.id:
+        return []
+    return prefix_match.group()
+
+
+def create_free_guilds_table(db_connection):
+    cursor = db_connection.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS free_guilds (
+        guild_id CHARACTER(18) PRIMARY KEY
+        );
+        """)
+
+
+def get_free_guild_ids_from_db(db_connection):
+    cursor = db_connection.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(
+        """
+        SELECT * FROM free_guilds
+        """,
+    )
+    results = cursor.fetchall()
+    return [result["guild_id"] for result in results]
+
+
+def add_free_guild_to_db(db_connection, guild_id):
+    cursor = db_connection.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(
+        """
+        INSERT INTO free_guilds (
+        guild_id)
+        VALUES (%s)
+        ON CONFLICT DO NOTHING
+        """,
+        (str(guild_id),))
+
 
 class Base(discord.ext.commands.Cog):
     def __init__(self, bot):
@@ -26,23 +78,21 @@ class Base(discord.ext.commands.Cog):
         If there are legal issues with an image, please join:
             discord.gg/JqfeT4J
         """
-        prefix_combinations = itertools.product('mMnN', 'bB', '.!', [' ', ''])
-        prefixes = [''.join(r) for r in prefix_combinations]
-        self.bot.command_prefix = commands.when_mentioned_or(*prefixes)
-        cursor = self.bot.db_connection.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS free_guilds (
-            guild_id CHARACTER(18) PRIMARY KEY
-            );
-            """)
-        self.bot.db_connection.commit()
+        self.bot.command_prefix = get_prefix
+        self.free_guild_ids = set()
+        """Mirror of the free_guilds table, checked on every message"""
+
+    async def cog_load(self):
+        await self.bot.db.run(create_free_guilds_table)
+        self.free_guild_ids = {
+            int(guild_id) for guild_id
+            in await self.bot.db.run(get_free_guild_ids_from_db)}
 
     @commands.command()
     @commands.guild_only()
     async def areyoufree(self, ctx):
         """If I have free reign I'll tell you"""
-        is_free = str(ctx.guild.id) in self.get_free_guild_ids()
+        is_free = self.is_free(ctx.guild.id)
         await ctx.send("Yes, I am free." if is_free else
                        "This is not a free reign guild.")
 
@@ -69,15 +119,8 @@ class Base(discord.ext.commands.Cog):
         )
         await ctx.send(link)
 
-    def get_free_guild_ids(self):
-        cursor = self.bot.db_connection.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(
-            """
-            SELECT * FROM free_guilds
-            """,
-        )
-        results = cursor.fetchall()
-        return [result["guild_id"] for result in results]
+    def is_free(self, guild_id):
+        return guild_id in self.free_guild_ids
 
     @commands.command()
     @commands.is_owner()
@@ -85,17 +128,10 @@ class Base(discord.ext.commands.Cog):
     async def gowild(self, ctx):
         """Add the current guild as a gowild guild; I do a bit more on these.
         Only Maku can add guilds though :("""
-        cursor = self.bot.db_connection.cursor(cursor_factory=RealDictCursor)
         if not ctx.message.guild:
             return
-        cursor.execute(
-            """
-            INSERT INTO free_guilds (
-            guild_id)
-            VALUES (%s)
-            """,
-            (str(ctx.message.guild.id),))
-        self.bot.db_connection.commit()
+        await self.bot.db.run(add_free_guild_to_db, ctx.message.guild.id)
+        self.free_guild_ids.add(ctx.message.guild.id)
         await ctx.send("Ayaya~")
 
 
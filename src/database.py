@@ -0,0 +1,160 @@
+"""
+Awaitable access to the database, so that queries don't block the event loop.
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import logging
+import time
+import psycopg2
+import psycopg2.pool
+
+logger = logging.getLogger()
+
+DATABASE_POOL_SIZE = 5
+DATABASE_CONNECT_MAX_RETRIES = 10
+DATABASE_CONNECT_RETRY_DELAY = 5  # seconds
+HEALTH_CHECK_IDLE_TIME = 30  # seconds
+
+
+class Transaction:
+    """
+    Runs database functions on one checked-out connection.
+    Everything run through it is committed or rolled back together.
+    """
+
+    def __init__(self, database, db_connection):
+        self.database = database
+        self.db_connection = db_connection
+
+    async def run(self, func, *args, **kwargs):
+        return await self.database.execute(
+            self.db_connection, func, *args, **kwargs)
+
+
+class Database:
+    """
+    A bounded pool of database connections, used from the event loop.
+    Functions take a connection as their first argument, like the ones in
+    picturecommands_utils, and are run on worker threads, either alone as
+    await bot.db.run(func, *args, **kwargs)
+    or grouped with
+    async with bot.db.transaction() as transaction:
+        await transaction.run(func, *args, **kwargs)
+    Functions shouldn't commit; the transaction does that when it ends.
+    """
+
+    def __init__(self, connection_pool, max_connections):
+        self.connection_pool = connection_pool
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_connections, thread_name_prefix="db")
+        self.checkout_semaphore = asyncio.Semaphore(max_connections)
+        self.last_used = {}
+        """Maps id(connection) to when it was last checked in"""
+
+    @classmethod
+    async def connect(cls,
+                      max_connections=DATABASE_POOL_SIZE,
+                      max_retries=DATABASE_CONNECT_MAX_RETRIES,
+                      **connect_kwargs):
+        create_pool = functools.partial(
+            psycopg2.pool.ThreadedConnectionPool,
+            1, max_connections, **connect_kwargs)
+        for _ in range(max_retries):
+            try:
+                connection_pool = (
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, create_pool))
+            except psycopg2.OperationalError:
+                logger.info(
+                    "Couldn't connect to mbdb, retrying in a few seconds")
+                await asyncio.sleep(DATABASE_CONNECT_RETRY_DELAY)
+            else:
+                return cls(connection_pool, max_connections)
+        raise psycopg2.OperationalError("Couldn't connect after retries")
+
+    def connection_is_healthy(self, db_connection):
+        if db_connection.closed:
+            return False
+        idle_time = (
+            time.monotonic()
+            - self.last_used.get(id(db_connection), time.monotonic()))
+        if idle_time < HEALTH_CHECK_IDLE_TIME:
+            return True
+        try:
+            db_connection.cursor().execute("SELECT 1")
+            db_connection.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+        return True
+
+    def checkout(self):
+        # Every connection in the pool might have gone stale at once
+        for _ in range(self.connection_pool.maxconn + 1):
+            db_connection = self.connection_pool.getconn()
+            if self.connection_is_healthy(db_connection):
+                return db_connection
+            logger.warning("Discarding broken database connection")
+            self.checkin(db_connection, close=True)
+        raise psycopg2.OperationalError("Couldn't get a healthy connection")
+
+    def checkin(self, db_connection, close=False):
+        close = close or bool(db_connection.closed)
+        if close:
+            self.last_used.pop(id(db_connection), None)
+        else:
+            self.last_used[id(db_connection)] = time.monotonic()
+        self.connection_pool.putconn(db_connection, close=close)
+
+    async def in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args)
+
+    async def execute(self, db_connection, func, *args, **kwargs):
+        future = self.executor.submit(func, db_connection, *args, **kwargs)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if not future.cancel() and not future.done():
+                logger.info(f"Cancelling query in {func!r}")
+                db_connection.cancel()
+            raise
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        async with self.checkout_semaphore:
+            db_connection = await self.in_executor(self.checkout)
+            try:
+                yield Transaction(self, db_connection)
+            except BaseException:
+                try:
+                    await asyncio.shield(
+                        self.in_executor(db_connection.rollback))
+                except psycopg2.Error:
+                    logger.warning("Rollback failed", exc_info=True)
+                self.checkin(db_connection)
+                raise
+            else:
+                try:
+                    await asyncio.shield(
+                        self.in_executor(db_connection.commit))
+                finally:
+                    self.checkin(db_connection)
+
+    async def run(self, func, *args, **kwargs):
+        try:
+            async with self.transaction() as transaction:
+                return await transaction.run(func, *args, **kwargs)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if e.pgcode is not None:
+                raise  # The server answered, so the connection is fine
+            # The connection dropped (eg Postgres restarted),
+            # so retry once on a fresh one
+            logger.warning(f"Retrying {func!r} after {e!r}")
+            async with self.transaction() as transaction:
+                return await transaction.run(func, *args, **kwargs)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.connection_pool.closeall()
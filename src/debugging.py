@@ -8,11 +8,18 @@ import asyncio
 import concurrent
 import sys
 from . import util
-from .picturecommands_utils import get_all_cmds_aliases_from_db
+from .picturecommands_utils import get_all_cmds_aliases_from_db, TRANSCODER
 
 logger = logging.getLogger()
 
 
+def execute_sql(db_connection, to_eval):
+    cursor = db_connection.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(to_eval)
+    results = [dict(row) for row in cursor.fetchall()]
+    return results
+
+
 class Debugging(discord.ext.commands.Cog):
     def __init__(self, bot):
         self.bot = bot
@@ -43,16 +50,8 @@ class Debugging(discord.ext.commands.Cog):
     @commands.command(hidden=True)
     @commands.is_owner()
     async def superevalsql(self, ctx, *, to_eval: str):
-        cursor = self.bot.db_connection.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(to_eval)
-        await ctx.send(str([dict(row) for row in cursor.fetchall()]))
-        self.bot.db_connection.commit()
-
-    @commands.command(hidden=True)
-    @commands.is_owner()
-    async def superevalrollback(self, ctx):
-        self.bot.db_connection.rollback()
-        await ctx.send("Done")
+        results = await self.bot.db.run(execute_sql, to_eval)
+        await ctx.send(str(results))
 
     @commands.command(hidden=True, aliases=["deletehist"])
     @commands.is_owner()
@@ -99,12 +98,20 @@ class Debugging(discord.ext.commands.Cog):
         current_servers_string = "Current servers: {}".format(
             {guild.name: guild.id for guild in self.bot.guilds})
         total_reactions = len(
-            get_all_cmds_aliases_from_db(self.bot.db_connection))
-        db_size = util.db_size(self.bot.db_connection)
+            await self.bot.db.run(get_all_cmds_aliases_from_db))
+        db_size = await self.bot.db.run(util.db_size)
+        reaction_images_cog = self.bot.get_cog("ReactionImages")
+        catalog_status = (reaction_images_cog.sync_status
+                          if reaction_images_cog else "not loaded")
+        presence = self.bot.get_cog("Listeners").presence
         status_text = (
             f"I'm in {len(self.bot.guilds)} servers!\n"
             f"I have {total_reactions} reaction commands.\n"
             f"The database size is {db_size}.\n"
+            f"The image catalog is {catalog_status}.\n"
+            f"{presence.num_requested} presence changes were requested, "
+            f"{presence.num_sent} sent and {presence.num_dropped} dropped.\n"
+            f"Transcoding: {TRANSCODER.status_text()}.\n"
             f"I'm using {util.hardware_usage()}.\n"
             f"{current_servers_string}")
         await util.displaytxt(ctx, status_text, blockify=True)
@@ -73,6 +73,12 @@ class MyHelpCommand(commands.DefaultHelpCommand):
             )
         )
 
+    async def command_not_found(self, string):
+        reaction_images_cog = self.context.bot.get_cog("ReactionImages")
+        if reaction_images_cog and string in reaction_images_cog.cmd_index:
+            return "Use this command to send an image from an image directory!"
+        return super().command_not_found(string)
+
     async def send_command_help(self, command):
         if command.callback.__name__ == "send_image_func":
             await self.get_destination().send(
@@ -91,9 +97,7 @@ class Help(discord.ext.commands.Cog):
     @commands.command()
     async def superhelp(self, ctx):
         all_non_image_commands = [
-            cmd for cmd, command in self.bot.all_commands.items()
-            if command != self.bot.all_commands["send_image_func"]
-        ]
+            cmd for cmd in self.bot.all_commands if cmd != "send_image_func"]
         await ctx.send(", ".join(all_non_image_commands))
 
 
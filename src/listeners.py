@@ -1,5 +1,7 @@
 import random
 import itertools
+import asyncio
+import time
 import discord
 import logging
 from discord.ext import commands, tasks
@@ -9,7 +11,6 @@ from discord.ext.commands.errors import (
     MissingRequiredArgument, BadArgument, PrivateMessageOnly, NoPrivateMessage,
     UserInputError,
 )
-import psycopg2
 from . import util
 
 logger = logging.getLogger()
@@ -20,15 +21,73 @@ STATUS_MESSAGES = [
     "mb.invite"
 ]
 
+PRESENCE_MIN_INTERVAL = 12  # seconds
+
+
+class PresenceManager:
+    """
+    Funnels presence changes so the gateway sees at most one per
+    min_interval. Requests that arrive in between replace each other,
+    and only the latest one is sent.
+    """
+
+    def __init__(self, change_presence, min_interval=PRESENCE_MIN_INTERVAL):
+        self.change_presence = change_presence
+        self.min_interval = min_interval
+        self.pending_activity = None
+        self.has_pending = False
+        self.sent_activity = None
+        self.last_sent = None
+        self.flush_task = None
+        self.num_requested = 0
+        self.num_sent = 0
+        self.num_dropped = 0
+
+    def request(self, activity):
+        self.num_requested += 1
+        if self.has_pending:
+            self.num_dropped += 1  # Superseded before it was sent
+        self.pending_activity = activity
+        self.has_pending = True
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        while self.has_pending:
+            if self.last_sent is not None:
+                wait_time = (
+                    self.last_sent + self.min_interval - time.monotonic())
+                if wait_time > 0:
+                    await asyncio.sleep(wait_time)
+            activity = self.pending_activity
+            self.has_pending = False
+            if activity == self.sent_activity:
+                self.num_dropped += 1
+                continue
+            self.last_sent = time.monotonic()
+            try:
+                await self.change_presence(activity=activity)
+            except discord.DiscordException:
+                logger.warning("Couldn't change presence", exc_info=True)
+                continue
+            self.sent_activity = activity
+            self.num_sent += 1
+
+    def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+
 
 class Listeners(discord.ext.commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.status_messages = itertools.cycle(STATUS_MESSAGES)
+        self.presence = PresenceManager(self.bot.change_presence)
         self.cycle_status_message.start()
 
     def cog_unload(self):
         self.cycle_status_message.stop()
+        self.presence.close()
 
     @commands.Cog.listener()
     async def on_command_error(self, ctx,
@@ -61,14 +120,6 @@ class Listeners(discord.ext.commands.Cog):
             await ctx.send("Something went wrong, sorry!")
             await self.bot.makusu.send(
                 f"Something went wrong!\n```{formatted_tb}```")
-            should_rollback = (
-                isinstance(caught_exception, psycopg2.DataError)
-                or (hasattr(caught_exception, "__cause__") and isinstance(caught_exception.__cause__, psycopg2.errors.InFailedSqlTransaction))
-                or (hasattr(caught_exception, "__cause__") and isinstance(caught_exception.__cause__, psycopg2.DataError))
-            )
-            if should_rollback:
-                await self.bot.makusu.send("Rolling back DB")
-                self.bot.db_connection.rollback()
 
     @commands.Cog.listener()
     async def on_error(self, ctx, caught_exception):
@@ -78,13 +129,9 @@ class Listeners(discord.ext.commands.Cog):
     async def on_message(self, message: discord.Message):
         if message.author.bot or not message.guild:
             return
-        guild_is_free = (
-            str(message.guild.id)
-            in self.bot.get_cog("Base").get_free_guild_ids()
-        )
+        guild_is_free = self.bot.get_cog("Base").is_free(message.guild.id)
         if guild_is_free or self.bot.user in message.mentions:
-            new_activity = discord.Game(name=message.author.name)
-            await self.bot.change_presence(activity=new_activity)
+            self.presence.request(discord.Game(name=message.author.name))
         if not guild_is_free:
             return
         if message.mention_everyone:
@@ -96,8 +143,7 @@ class Listeners(discord.ext.commands.Cog):
 
     @tasks.loop(seconds=10)
     async def cycle_status_message(self):
-        new_activity = discord.Game(name=next(self.status_messages))
-        await self.bot.change_presence(activity=new_activity)
+        self.presence.request(discord.Game(name=next(self.status_messages)))
 
     @cycle_status_message.before_loop
     async def before_cycle_status_message(self):
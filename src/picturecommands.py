@@ -1,51 +1,70 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 import logging
-import random
+import functools
 import aiohttp
 import asyncio
 import concurrent
+import multiprocessing
 import youtube_dl
 import hashlib
-import mimetypes
+import io
+import os
+import csv
+import datetime
+import tempfile
 import boto3
+import botocore
+import psycopg2.extras
 from . import util
 from .picturecommands_utils import (
     YES_EMOJI,
     NO_EMOJI,
     cmd_has_hash,
-    get_all_true_cmds_from_db,
     get_all_cmd_images_from_db,
     command_exists_in_db,
     add_cmd_to_db,
     image_exists_in_cmd,
     add_image_to_db,
-    get_cmd_from_alias,
+    CommandAliasIndex,
+    CandidateImageCache,
     add_alias_to_db,
     get_media_bytes_and_name,
+    download_media,
+    DownloadService,
+    MediaTooLarge,
+    QualityTooLow,
+    make_gif_rendition,
+    make_still_variant,
+    IMAGE_WORKERS,
+    hash_image,
+    BKTree,
+    NEAR_DUPLICATE_DISTANCE,
+    get_unhashed_images_from_db,
+    set_image_phash_in_db,
     cascade_deleted_referenced_aliases,
-    get_starting_keys_hashes,
+    list_s3_pictures,
+    group_s3_objects,
+    split_picture_key,
+    get_s3_manifest_from_db,
+    save_s3_manifest,
+    diff_s3_manifest,
     delete_cmd_and_all_images,
     delete_image_from_db,
-    get_random_image,
+    RandomImageSampler,
     generate_image_embed,
+    generate_video_message,
     get_cmd_uid,
     add_server_command_association,
-    get_user_sids,
-    get_user_origin_server_intersection,
-    get_appropriate_images,
-    img_sid_should_be_set,
-    set_img_sid,
-    get_all_cmds_aliases_from_db,
-    get_cmd_sizes,
+    stamp_img_sid,
+    get_cmd_image_rows_from_db,
+    CommandSizeCounter,
     cmd_info,
     image_info,
     set_cmd_images_owner_on_db,
     set_cmd_images_server_on_db,
     get_all_user_cmds,
     get_all_user_images,
-    get_cmd_aliases_from_db,
-    get_cmd_size_server_user,
     add_blacklist_association,
     get_user_blacklist,
     remove_blacklist_association,
@@ -55,43 +74,325 @@ logger = logging.getLogger()
 
 S3 = boto3.client("s3")
 
+S3_RECONCILE_INTERVAL = 15  # minutes
+ADDIMAGE_CONCURRENCY = 4
+# Margin between our clock and S3's and Postgres's when deciding
+# what a listing could have missed
+S3_CLOCK_SKEW = datetime.timedelta(minutes=1)
 
-def sync_s3_db(db_connection, collection_keys, collection_hashes):
-    missing_cmds = [
-        cmd for cmd in collection_keys
-        if not command_exists_in_db(db_connection, cmd)]
-    if missing_cmds:
-        logger.info(f"DB didn't have cmds, adding: {missing_cmds=}")
-    for cmd in missing_cmds:
-        add_cmd_to_db(db_connection, cmd, uid=None, sid=None)
+
+def create_media_tables(db_connection):
+    cursor = db_connection.cursor()
+    cursor.execute(
+        """
+        CREATE SCHEMA IF NOT EXISTS media;
+        CREATE TABLE IF NOT EXISTS media.commands (
+            cmd TEXT PRIMARY KEY,
+            uid CHARACTER(18));
+        CREATE TABLE IF NOT EXISTS media.images (
+            cmd TEXT REFERENCES media.commands(cmd) ON DELETE CASCADE,
+            image_key TEXT,
+            uid CHARACTER(18),
+            sid CHARACTER(19),
+            md5 TEXT,
+            PRIMARY KEY (cmd, image_key));
+        CREATE TABLE IF NOT EXISTS media.server_command_associations (
+            sid CHARACTER(19),
+            cmd TEXT REFERENCES media.commands(cmd) ON DELETE CASCADE,
+            PRIMARY KEY (sid, cmd));
+        CREATE TABLE IF NOT EXISTS media.aliases (
+            alias TEXT PRIMARY KEY,
+            real TEXT);
+        CREATE TABLE IF NOT EXISTS media.blacklist_associations (
+            cmd TEXT REFERENCES media.commands(cmd) ON DELETE CASCADE,
+            image_key TEXT,
+            uid CHARACTER(18),
+            PRIMARY KEY (cmd, image_key, uid));
+        ALTER TABLE media.images
+            ADD COLUMN IF NOT EXISTS content_type TEXT,
+            ADD COLUMN IF NOT EXISTS size BIGINT,
+            ADD COLUMN IF NOT EXISTS rendition_key TEXT,
+            ADD COLUMN IF NOT EXISTS rendition_content_type TEXT,
+            ADD COLUMN IF NOT EXISTS rendition_size BIGINT,
+            ADD COLUMN IF NOT EXISTS phash BIGINT,
+            ADD COLUMN IF NOT EXISTS added_at TIMESTAMPTZ;
+        ALTER TABLE media.images
+            ALTER COLUMN added_at SET DEFAULT now();
+        CREATE TABLE IF NOT EXISTS media.s3_manifest (
+            s3_key TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TIMESTAMPTZ);
+        """
+    )
+
+
+def sync_s3_db(
+        db_connection, collection_keys, collection_hashes, collection_sizes,
+        listing_started=None):
+    """
+    Makes media.commands and media.images match what's in S3.
+    Images added after listing_started may be missing from the listing,
+    so they're kept.
+    The S3 listing is staged into a temp table with COPY and diffed against
+    the database with set-based statements, all in the caller's transaction.
+    Returns counts of what was added and removed.
+    """
+    manifest_csv = io.StringIO()
+    csv_writer = csv.writer(manifest_csv)
     for cmd in collection_keys:
         assert (len(collection_keys[cmd])
-                == len(collection_hashes[cmd]))
-        missing_key_hash_pairs = [
-            (image_key, image_hash)
-            for (image_key, image_hash)
-            in zip(collection_keys[cmd], collection_hashes[cmd])
-            if not image_exists_in_cmd(db_connection, image_key, cmd)
-        ]
-        if missing_key_hash_pairs:
-            logger.info(f"Adding to DB {missing_key_hash_pairs=}")
-        for image_key, image_hash in missing_key_hash_pairs:
-            add_image_to_db(
-                db_connection, image_key, cmd, uid=None,
-                sid=None, md5=image_hash)
-
-    for cmd in get_all_true_cmds_from_db(db_connection):
-        if cmd not in collection_keys:
-            logger.warning(f"{cmd} wasn't in S3, so it's being removed "
-                           f"from the database.")
-            delete_cmd_and_all_images(db_connection, cmd)
-            continue
-        cmd_image_keys = (
-            get_all_cmd_images_from_db(db_connection, cmd))
-        for image_key in cmd_image_keys:
-            if image_key not in collection_keys[cmd]:
-                delete_image_from_db(
-                    db_connection, cmd, image_key)
+                == len(collection_hashes[cmd])
+                == len(collection_sizes[cmd]))
+        for image_key, image_hash, image_size in zip(
+                collection_keys[cmd],
+                collection_hashes[cmd],
+                collection_sizes[cmd]):
+            csv_writer.writerow((
+                cmd, image_key, image_hash,
+                util.guess_content_type(image_key), image_size))
+    manifest_csv.seek(0)
+
+    cursor = db_connection.cursor()
+    cursor.execute(
+        """
+        CREATE TEMP TABLE s3_manifest (
+            cmd TEXT,
+            image_key TEXT,
+            md5 TEXT,
+            content_type TEXT,
+            size BIGINT,
+            PRIMARY KEY (cmd, image_key))
+        ON COMMIT DROP;
+        """
+    )
+    cursor.copy_expert(
+        "COPY s3_manifest FROM STDIN WITH (FORMAT csv)", manifest_csv)
+    cursor.execute("ANALYZE s3_manifest;")
+
+    cursor.execute(
+        """
+        INSERT INTO media.commands (cmd)
+        SELECT DISTINCT cmd FROM s3_manifest
+        ON CONFLICT DO NOTHING
+        RETURNING cmd;
+        """
+    )
+    added_cmds = [row[0] for row in cursor.fetchall()]
+    cursor.execute(
+        """
+        INSERT INTO media.images (cmd, image_key, md5, content_type, size)
+        SELECT cmd, image_key, md5, content_type, size FROM s3_manifest
+        ON CONFLICT DO NOTHING;
+        """
+    )
+    num_added = cursor.rowcount
+    cursor.execute(
+        """
+        UPDATE media.images AS images
+        SET content_type = manifest.content_type, size = manifest.size
+        FROM s3_manifest AS manifest
+        WHERE images.cmd = manifest.cmd
+        AND images.image_key = manifest.image_key
+        AND images.content_type IS NULL;
+        """
+    )
+    num_backfilled = cursor.rowcount
+    cursor.execute(
+        """
+        DELETE FROM media.images AS images
+        WHERE NOT EXISTS (
+            SELECT 1 FROM s3_manifest AS manifest
+            WHERE manifest.cmd = images.cmd
+            AND manifest.image_key = images.image_key
+        )
+        AND (images.added_at IS NULL OR %s IS NULL
+             OR images.added_at < %s);
+        """,
+        (listing_started, listing_started)
+    )
+    num_removed = cursor.rowcount
+    cursor.execute(
+        """
+        DELETE FROM media.commands AS commands
+        WHERE NOT EXISTS (
+            SELECT 1 FROM media.images AS images
+            WHERE images.cmd = commands.cmd
+        )
+        RETURNING cmd;
+        """
+    )
+    removed_cmds = [row[0] for row in cursor.fetchall()]
+    if removed_cmds:
+        logger.warning(f"{removed_cmds=} weren't in S3, so they're being "
+                       f"removed from the database.")
+    sync_counts = {
+        "added": num_added,
+        "removed": num_removed,
+        "backfilled": num_backfilled,
+        "added_cmds": len(added_cmds),
+        "removed_cmds": len(removed_cmds),
+    }
+    logger.info(f"Synced S3 to DB: {sync_counts}")
+    return sync_counts
+
+
+def apply_s3_delta(db_connection, changed_contents, removed_keys, manifest):
+    """
+    Applies the S3 objects that changed since the last sync to
+    media.commands and media.images, leaving everything else untouched.
+    Returns the sync counts, the S3 keys of renditions made from
+    content that has since been replaced, and the (cmd, image_key)s
+    that need hashing.
+    """
+    cursor = db_connection.cursor()
+    changed_rows = []
+    unseen_multipart_rows = []
+    for content in changed_contents:
+        cmd, image_key = split_picture_key(content["Key"])
+        etag = content["ETag"][1:-1]
+        previous_etag, _ = manifest.get(content["Key"], (None, None))
+        if etag == previous_etag:
+            continue  # Only LastModified moved, the content is the same
+        row = (cmd, image_key, etag,
+               util.guess_content_type(image_key), content["Size"])
+        # Multipart ETags aren't MD5s, so they can't be compared to md5.
+        # Without an earlier ETag to compare to, only add missing rows.
+        if previous_etag is None and "-" in etag:
+            unseen_multipart_rows.append(row)
+        else:
+            changed_rows.append(row)
+    added_cmds = psycopg2.extras.execute_values(
+        cursor,
+        """
+        INSERT INTO media.commands (cmd)
+        VALUES %s
+        ON CONFLICT DO NOTHING
+        RETURNING cmd;
+        """,
+        list({(cmd,) for cmd, *_ in changed_rows + unseen_multipart_rows}),
+        fetch=True
+    )
+    stale_renditions = psycopg2.extras.execute_values(
+        cursor,
+        """
+        SELECT images.cmd, images.rendition_key FROM media.images AS images
+        JOIN (VALUES %s) AS changed (cmd, image_key, md5)
+        ON images.cmd = changed.cmd AND images.image_key = changed.image_key
+        WHERE images.md5 IS DISTINCT FROM changed.md5
+        AND images.rendition_key IS NOT NULL;
+        """,
+        [(cmd, image_key, md5) for cmd, image_key, md5, *_ in changed_rows],
+        fetch=True
+    )
+    updated_images = psycopg2.extras.execute_values(
+        cursor,
+        """
+        INSERT INTO media.images (cmd, image_key, md5, content_type, size)
+        VALUES %s
+        ON CONFLICT (cmd, image_key) DO UPDATE
+        SET md5 = EXCLUDED.md5,
+            content_type = EXCLUDED.content_type,
+            size = EXCLUDED.size,
+            rendition_key = NULL,
+            rendition_content_type = NULL,
+            rendition_size = NULL,
+            phash = NULL
+        WHERE media.images.md5 IS DISTINCT FROM EXCLUDED.md5
+        RETURNING cmd, image_key;
+        """,
+        changed_rows,
+        fetch=True
+    )
+    added_multipart_images = psycopg2.extras.execute_values(
+        cursor,
+        """
+        INSERT INTO media.images (cmd, image_key, md5, content_type, size)
+        VALUES %s
+        ON CONFLICT DO NOTHING
+        RETURNING cmd, image_key;
+        """,
+        unseen_multipart_rows,
+        fetch=True
+    )
+    # New or replaced content, which needs a fresh perceptual hash
+    unhashed_images = [
+        (cmd, image_key)
+        for cmd, image_key in updated_images + added_multipart_images
+        if util.content_type_is_image(util.guess_content_type(image_key))]
+    removed_pairs = [split_picture_key(key) for key in removed_keys]
+    removed_images = psycopg2.extras.execute_values(
+        cursor,
+        """
+        DELETE FROM media.images AS images
+        USING (VALUES %s) AS removed (cmd, image_key)
+        WHERE images.cmd = removed.cmd
+        AND images.image_key = removed.image_key
+        RETURNING images.cmd;
+        """,
+        removed_pairs,
+        fetch=True
+    )
+    cursor.execute(
+        """
+        DELETE FROM media.commands AS commands
+        WHERE cmd = ANY(%s)
+        AND NOT EXISTS (
+            SELECT 1 FROM media.images AS images
+            WHERE images.cmd = commands.cmd
+        )
+        RETURNING cmd;
+        """,
+        (list({cmd for cmd, _ in removed_pairs}),)
+    )
+    removed_cmds = [row[0] for row in cursor.fetchall()]
+    if removed_cmds:
+        logger.warning(f"{removed_cmds=} were emptied in S3, so they're "
+                       f"being removed from the database.")
+    sync_counts = {
+        "changed": len(updated_images) + len(added_multipart_images),
+        "removed": len(removed_images),
+        "added_cmds": len(added_cmds),
+        "removed_cmds": len(removed_cmds),
+    }
+    logger.info(f"Synced S3 delta to DB: {sync_counts}")
+    stale_rendition_keys = [f"renditions/{cmd}/{rendition_key}"
+                            for cmd, rendition_key in stale_renditions]
+    return sync_counts, stale_rendition_keys, unhashed_images
+
+
+def reconcile_s3_db(db_connection, contents, listing_started=None):
+    """
+    Brings the database up to date with an S3 listing that began at
+    listing_started, leaving alone whatever the bot added since.
+    Only objects that changed since the persisted manifest are processed,
+    except on the first run, when everything is diffed in bulk.
+    Returns the sync counts, the S3 keys of renditions to delete,
+    and the (cmd, image_key)s that need hashing.
+    """
+    manifest = get_s3_manifest_from_db(db_connection)
+    if manifest:
+        changed_contents, removed_keys = diff_s3_manifest(
+            manifest, contents, listing_started)
+        sync_counts, stale_rendition_keys, unhashed_images = apply_s3_delta(
+            db_connection, changed_contents, removed_keys, manifest)
+    else:
+        changed_contents, removed_keys = contents, []
+        sync_counts = sync_s3_db(
+            db_connection, *group_s3_objects(contents), listing_started)
+        # Too many to hash here; hashimages backfills them
+        stale_rendition_keys, unhashed_images = [], []
+    save_s3_manifest(db_connection, changed_contents, removed_keys)
+    return sync_counts, stale_rendition_keys, unhashed_images
+
+
+def delete_s3_objects(bucket, keys, batch_size=1000):
+    """S3 deletes at most 1000 keys per request"""
+    for batch_start in range(0, len(keys), batch_size):
+        S3.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [
+                {"Key": key}
+                for key in keys[batch_start:batch_start + batch_size]]})
 
 
 def collection_has_image_bytes(
@@ -104,6 +405,25 @@ class PictureAdder(discord.ext.commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.pending_approval_message_ids = []
+        self.downloads = DownloadService(download_media)
+        """Every addimage download waits its turn here"""
+        # Forking a process this threaded can copy a held lock into
+        # a worker, so workers start from a clean forkserver instead
+        self.image_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS,
+            mp_context=multiprocessing.get_context("forkserver"))
+
+    def cog_unload(self):
+        self.downloads.close()
+        self.image_pool.shutdown(wait=False)
+
+    @property
+    def reaction_images(self):
+        return self.bot.get_cog("ReactionImages")
+
+    @property
+    def cmd_index(self):
+        return self.reaction_images.cmd_index
 
     async def get_approval(self, request_id, peek_count=3):
         assert request_id not in self.pending_approval_message_ids
@@ -137,15 +457,16 @@ class PictureAdder(discord.ext.commands.Cog):
 
     async def image_suggestion(self, image_collection, filepath, requestor,
                                image_bytes=None, status_message=None,
-                               temp_dir=None):
+                               temp_dir=None, rendition_path=None,
+                               phash=None):
         if filepath is None or temp_dir is None or image_bytes is None:
             raise ValueError("filepath, temp_dir, and image_bytes must be set")
         filename = filepath.split("/")[-1]
         try:
             with open(filepath, "rb") as f:
                 image_bytes = f.read()
-            if collection_has_image_bytes(
-                    self.bot.db_connection, image_collection, image_bytes,):
+            if await self.bot.db.run(
+                    collection_has_image_bytes, image_collection, image_bytes):
                 response = (
                     f"The image {filename} appears already in the collection!")
                 await requestor.send(response)
@@ -154,12 +475,13 @@ class PictureAdder(discord.ext.commands.Cog):
                 except discord.errors.NotFound:
                     pass
                 return
-            is_new = (
-                image_collection not in
-                get_all_true_cmds_from_db(self.bot.db_connection))
+            is_new = image_collection not in self.cmd_index
             new_addition = "***NEW*** " if is_new else ""
+            near_duplicates = self.near_duplicate_warning(
+                image_collection, phash)
             proposal = (f"Add image {filename} to {new_addition}"
-                        f"{image_collection}? Requested by {requestor.name}")
+                        f"{image_collection}? Requested by {requestor.name}"
+                        f"{near_duplicates}")
             try:
                 request = await self.bot.makusu.send(
                     proposal, file=discord.File(filepath))
@@ -189,8 +511,8 @@ class PictureAdder(discord.ext.commands.Cog):
             approval_time = discord.utils.utcnow() - approval_start_time
             logger.info(f"{filename} took {approval_time} to get approved")
             await request.delete()
-            if collection_has_image_bytes(
-                    self.bot.db_connection, image_collection, image_bytes):
+            if await self.bot.db.run(
+                    collection_has_image_bytes, image_collection, image_bytes):
                 response = (
                     f"The image {filename} appears already in the collection!")
                 await requestor.send(response)
@@ -214,7 +536,9 @@ class PictureAdder(discord.ext.commands.Cog):
                 image_collection,
                 requestor,
                 status_message,
-                image_bytes)
+                image_bytes,
+                rendition_path=rendition_path,
+                phash=phash)
         except (concurrent.futures._base.CancelledError,
                 asyncio.exceptions.CancelledError):
             logger.error(f"Cancelled error on {filename}")
@@ -231,29 +555,71 @@ class PictureAdder(discord.ext.commands.Cog):
                 "Something went wrong in image_suggestion"
                 f"\n```{formatted_tb}```")
 
-    async def apply_image_approved(
-            self, filepath, cmd, requestor, status_message, image_bytes):
-        filename = filepath.split("/")[-1]
-        existing_keys = get_all_cmd_images_from_db(self.bot.db_connection, cmd)
-        image_key = util.get_nonconflicting_filename(
-            filename, existing_keys=existing_keys)
-        full_image_key = f"pictures/{cmd}/{image_key}"
+    def near_duplicate_warning(self, image_collection, phash,
+                               max_listed=3):
+        """Lines for the approval request listing lookalike images"""
+        if phash is None:
+            return ""
+        matches = self.reaction_images.phash_index.search(
+            phash, NEAR_DUPLICATE_DISTANCE)
+        # Lookalikes in the same collection are the likelier mistake
+        matches.sort(key=lambda match: (
+            match[1][0] != image_collection, match[0]))
+        warning = "".join(
+            f"\n:warning: Looks like {cmd}/{image_key} "
+            f"({distance} bits off)"
+            for distance, (cmd, image_key) in matches[:max_listed])
+        if len(matches) > max_listed:
+            warning += f"\n...and {len(matches) - max_listed} more"
+        return warning
 
-        def upload_image_func():
-            mimetype, _ = mimetypes.guess_type(filepath)
-            mimetype = mimetype or "binary/octet-steam"
-            return S3.upload_file(
+    async def upload_to_s3(self, filepath, s3_key, content_type):
+        """
+        Returns the uploaded object as an S3 listing entry,
+        so it can go straight into media.s3_manifest
+        """
+        def upload_func():
+            S3.upload_file(
                 str(filepath),
                 self.bot.s3_bucket,
-                full_image_key,
+                s3_key,
                 ExtraArgs={
                     "ACL": "public-read",
-                    "ContentType": mimetype
+                    "ContentType": content_type
                 }
             )
+            head = S3.head_object(Bucket=self.bot.s3_bucket, Key=s3_key)
+            return {"Key": s3_key, "ETag": head["ETag"],
+                    "LastModified": head["LastModified"]}
         with concurrent.futures.ThreadPoolExecutor() as pool:
-            await asyncio.get_running_loop().run_in_executor(
-                pool, upload_image_func)
+            return await asyncio.get_running_loop().run_in_executor(
+                pool, upload_func)
+
+    async def apply_image_approved(
+            self, filepath, cmd, requestor, status_message, image_bytes,
+            rendition_path=None, phash=None):
+        filename = filepath.split("/")[-1]
+        existing_keys = await self.bot.db.run(get_all_cmd_images_from_db, cmd)
+        image_key = util.get_nonconflicting_filename(
+            filename, existing_keys=existing_keys)
+        full_image_key = f"pictures/{cmd}/{image_key}"
+
+        content_type = util.guess_content_type(filepath)
+        uploaded_object = await self.upload_to_s3(
+            filepath, full_image_key, content_type)
+
+        rendition_key = rendition_content_type = rendition_size = None
+        if rendition_path:
+            rendition_extension = os.path.splitext(rendition_path)[1]
+            rendition_key = (
+                image_key if image_key.lower().endswith(rendition_extension)
+                else f"{image_key}{rendition_extension}")
+            rendition_content_type = util.guess_content_type(rendition_path)
+            rendition_size = os.path.getsize(rendition_path)
+            await self.upload_to_s3(
+                rendition_path, f"renditions/{cmd}/{rendition_key}",
+                rendition_content_type)
+
         md5 = hashlib.md5(image_bytes).hexdigest()
 
         try:
@@ -262,16 +628,36 @@ class PictureAdder(discord.ext.commands.Cog):
             sid = None
         uid = requestor.id
 
-        if not command_exists_in_db(self.bot.db_connection, cmd):
-            add_cmd_to_db(self.bot.db_connection, cmd, uid=uid, sid=sid)
-            self.bot.get_command("send_image_func").aliases.append(cmd)
-            self.bot.all_commands[cmd] = self.bot.all_commands[
-                "send_image_func"]
+        async with self.bot.db.transaction() as transaction:
+            is_new_cmd = not await transaction.run(command_exists_in_db, cmd)
+            if is_new_cmd:
+                await transaction.run(add_cmd_to_db, cmd, uid=uid, sid=sid)
+            # An S3 sync may have inserted it already, without an owner
+            is_new_image = not await transaction.run(
+                image_exists_in_cmd, image_key, cmd)
+            await transaction.run(
+                add_image_to_db, image_key, cmd,
+                uid=uid, sid=sid, md5=md5,
+                content_type=content_type, size=len(image_bytes),
+                rendition_key=rendition_key,
+                rendition_content_type=rendition_content_type,
+                rendition_size=rendition_size,
+                phash=phash)
+            # Otherwise the next reconciliation sees it as changed in S3.
+            # Before the first sync, an empty manifest means a full sync
+            # is still due, so leave it empty.
+            if self.reaction_images.catalog_synced.is_set():
+                await transaction.run(
+                    save_s3_manifest, [uploaded_object], [])
 
-        if not image_exists_in_cmd(self.bot.db_connection, image_key, cmd):
-            add_image_to_db(
-                self.bot.db_connection, image_key, cmd,
-                uid=uid, sid=sid, md5=md5)
+        if is_new_cmd:
+            self.cmd_index.add_cmd(cmd)
+        if is_new_image:
+            self.reaction_images.catalog_image_added(
+                cmd, image_key, phash=phash)
+        else:
+            self.reaction_images.catalog_image_replaced(
+                cmd, image_key, phash=phash)
 
         response = f"Your image `{image_key}` was approved!"
         await requestor.send(response)
@@ -283,27 +669,60 @@ class PictureAdder(discord.ext.commands.Cog):
     @commands.command(hidden=True, aliases=["aliasimage", "aliaspicture"])
     @commands.is_owner()
     async def add_picture_alias(self, ctx, alias, real):
-        send_image_cmd = self.bot.get_command("send_image_func")
         if not alias.isalnum() or not real.isalnum():
             await ctx.send("Please only include letters and numbers.")
             return
-        elif self.bot.get_command(alias):
+        elif self.bot.get_command(alias) or alias in self.cmd_index:
             await ctx.send(f"{alias} is already a command :<")
             return
-        elif real not in send_image_cmd.aliases:
+        elif real not in self.cmd_index:
             await ctx.send(
                 f"{real} isn't an image command, though :<")
             return
-        real = get_cmd_from_alias(self.bot.db_connection, real)
-        add_alias_to_db(self.bot.db_connection, alias, real)
-        send_image_cmd.aliases.append(alias)
-        self.bot.all_commands[alias] = self.bot.all_commands["send_image_func"]
+        real = self.cmd_index.resolve(real)
+        await self.bot.db.run(add_alias_to_db, alias, real)
+        self.cmd_index.add_alias(alias, real)
         await ctx.send("Added!")
 
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def hashimages(self, ctx):
+        """Computes perceptual hashes for images added before they existed"""
+        unhashed_images = await self.bot.db.run(get_unhashed_images_from_db)
+        await ctx.send(f"Hashing {len(unhashed_images)} images...")
+        num_hashed = await self.hash_images(unhashed_images)
+        await ctx.send(f"Hashed {num_hashed} images!")
+
+    async def hash_images(self, images):
+        """
+        Downloads each (cmd, image_key) from S3 and stores its perceptual
+        hash. Returns how many could be hashed.
+        """
+        num_hashed = 0
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for cmd, image_key in images:
+                filepath = os.path.join(temp_dir, image_key)
+                try:
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, S3.download_file, self.bot.s3_bucket,
+                        f"pictures/{cmd}/{image_key}", filepath)
+                except botocore.exceptions.ClientError:
+                    logger.warning(f"Couldn't download {cmd}/{image_key}")
+                    continue
+                phash = await hash_image(self.image_pool, filepath)
+                os.remove(filepath)
+                if phash is None:
+                    continue
+                await self.bot.db.run(
+                    set_image_phash_in_db, cmd, image_key, phash)
+                self.reaction_images.phash_index.add((cmd, image_key), phash)
+                num_hashed += 1
+        return num_hashed
+
     @commands.command(aliases=["mycmds"])
     async def mycommands(self, ctx):
         """Shows you all your commands!"""
-        all_cmds = get_all_user_cmds(self.bot.db_connection, ctx.author.id)
+        all_cmds = await self.bot.db.run(get_all_user_cmds, ctx.author.id)
         all_cmds_str = ", ".join(all_cmds)
         if all_cmds:
             await ctx.send(f"All your commands: {all_cmds_str}")
@@ -313,7 +732,7 @@ class PictureAdder(discord.ext.commands.Cog):
     @commands.command()
     async def myimagecount(self, ctx):
         """Shows you how many images you've added!"""
-        all_images = get_all_user_images(self.bot.db_connection, ctx.author.id)
+        all_images = await self.bot.db.run(get_all_user_images, ctx.author.id)
         await ctx.send(f"You have {len(all_images)} owned images!")
 
     @commands.command()
@@ -341,14 +760,9 @@ you just need to add an image to it!"""
         if not image_collection.isalnum() or not image_collection.isascii():
             await ctx.send("Please only include ascii letters and numbers.")
             return
-        image_collection = get_cmd_from_alias(
-            self.bot.db_connection, image_collection
-        ) or image_collection
-        existing_command = (
-            self.bot.all_commands.get(image_collection, None)
-            if image_collection else None)
-        send_image_command = self.bot.all_commands["send_image_func"]
-        if existing_command and (existing_command != send_image_command):
+        image_collection = (
+            self.cmd_index.resolve(image_collection) or image_collection)
+        if image_collection in self.bot.all_commands:
             await ctx.send("That is already a non-image command name.")
             return
         if not urls and not ctx.message.attachments:
@@ -357,113 +771,275 @@ you just need to add an image to it!"""
             return
         urls = urls.split() + [attachment.url for attachment
                                in ctx.message.attachments]
-        image_suggestion_coros = []
         loading_emoji = discord.utils.get(self.bot.emojis,
                                           name="makubot_loading")
-        for url in urls:
-            try:
-                status_message = await ctx.send(f"Querying... {loading_emoji}")
+        status_messages = [
+            await ctx.send(f"Querying... {loading_emoji}") for _ in urls]
+        ingest_semaphore = asyncio.Semaphore(ADDIMAGE_CONCURRENCY)
+        seen_hashes = set()
+        # ingest_url reports its own failures, and one URL failing
+        # mustn't cancel the others, which may be waiting for approval
+        results = await asyncio.gather(*[
+            self.ingest_url(
+                url, image_collection, ctx.author, status_message,
+                ingest_semaphore, seen_hashes, loading_emoji=loading_emoji)
+            for url, status_message in zip(urls, status_messages)],
+            return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error("Got exception in addimage: ", exc_info=result)
+
+    async def ingest_url(self, url, image_collection, requestor,
+                         status_message, ingest_semaphore, seen_hashes,
+                         loading_emoji=""):
+        """
+        Downloads and converts one URL from an addimage, then asks for
+        approval, without waiting on the other URLs from the same addimage
+        """
+        try:
+            async with ingest_semaphore:
                 data, filepath, temp_dir = await get_media_bytes_and_name(
-                    url, status_message=status_message,
+                    url, self.downloads, requestor.id,
+                    status_message=status_message,
                     loading_emoji=loading_emoji)
-            except(youtube_dl.utils.DownloadError,
-                   aiohttp.client_exceptions.ClientConnectorError,
-                   aiohttp.client_exceptions.InvalidURL,
-                   discord.errors.HTTPException,
-                   FileNotFoundError) as e:
-                traceback = util.get_formatted_traceback(e)
-                logger.warning(f"Couldn't download image: {traceback}")
-                await asyncio.sleep(1)  # TODO fix race condition, added to
-                # counter status message update from separate thread
-                await status_message.edit(content="I can't download that ;a;")
-            except (concurrent.futures._base.CancelledError,
-                    asyncio.exceptions.CancelledError):
-                await status_message.edit(
-                    content="Sorry, the download messed up; please try again!")
-                return
-            except BaseException as e:
-                formatted_tb = util.get_formatted_traceback(e)
-                await status_message.edit(content="Something went wrong ;a;")
-                await self.bot.makusu.send(
-                    f"Something went wrong in addimage\n```{formatted_tb}```")
-                raise
-            else:
-                await status_message.edit(content="Sent to Maku for approval!")
-                image_suggestion_coros.append(self.image_suggestion(
-                    image_collection, filepath, ctx.author,
-                    image_bytes=data, status_message=status_message,
-                    temp_dir=temp_dir))
-        all_suggestion_coros = asyncio.gather(*image_suggestion_coros)
+        except MediaTooLarge as e:
+            logger.info(f"Refusing to download: {e}")
+            await status_message.edit(
+                content="That's too big for me to download ;a;")
+            return
+        except (youtube_dl.utils.DownloadError,
+                aiohttp.client_exceptions.ClientConnectorError,
+                aiohttp.client_exceptions.InvalidURL,
+                discord.errors.HTTPException,
+                FileNotFoundError) as e:
+            traceback = util.get_formatted_traceback(e)
+            logger.warning(f"Couldn't download image: {traceback}")
+            await status_message.edit(content="I can't download that ;a;")
+            return
+        except QualityTooLow as e:
+            logger.info(f"Refusing to encode: {e}")
+            await status_message.edit(
+                content="That's too long for me to fit in a message ;a;")
+            return
+        except asyncio.TimeoutError:
+            logger.warning(f"Processing {url} timed out")
+            await status_message.edit(
+                content="That took too long to process ;a;")
+            return
+        except (concurrent.futures._base.CancelledError,
+                asyncio.exceptions.CancelledError):
+            await status_message.edit(
+                content="Sorry, the download messed up; please try again!")
+            return
+        except Exception as e:
+            formatted_tb = util.get_formatted_traceback(e)
+            await status_message.edit(content="Something went wrong ;a;")
+            await self.bot.makusu.send(
+                f"Something went wrong in addimage\n```{formatted_tb}```")
+            return
+        image_hash = hashlib.md5(data).hexdigest()
+        if image_hash in seen_hashes:
+            await status_message.edit(
+                content="You already sent that one in this batch!")
+            temp_dir.cleanup()
+            return
+        seen_hashes.add(image_hash)
+        # Renditions and hashes are nice to have, so the original
+        # still goes to Maku without them if making them fails
         try:
-            await all_suggestion_coros
-        except BaseException:
-            logger.error("Got exception in addimage: ", exc_info=True)
-            all_suggestion_coros.cancel()
+            rendition_path = (
+                await make_gif_rendition(filepath)
+                or await make_still_variant(self.image_pool, filepath))
+        except Exception:
+            logger.exception(f"Couldn't make a rendition of {filepath}")
+            rendition_path = None
+        try:
+            phash = await hash_image(self.image_pool, filepath)
+        except Exception:
+            logger.exception(f"Couldn't hash {filepath}")
+            phash = None
+        await status_message.edit(content="Sent to Maku for approval!")
+        await self.image_suggestion(
+            image_collection, filepath, requestor,
+            image_bytes=data, status_message=status_message,
+            temp_dir=temp_dir, rendition_path=rendition_path, phash=phash)
 
 
 class ReactionImages(discord.ext.commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-
-        cursor = self.bot.db_connection.cursor()
-        cursor.execute(
-            """
-            CREATE SCHEMA IF NOT EXISTS media;
-            CREATE TABLE IF NOT EXISTS media.commands (
-                cmd TEXT PRIMARY KEY,
-                uid CHARACTER(18));
-            CREATE TABLE IF NOT EXISTS media.images (
-                cmd TEXT REFERENCES media.commands(cmd) ON DELETE CASCADE,
-                image_key TEXT,
-                uid CHARACTER(18),
-                sid CHARACTER(19),
-                md5 TEXT,
-                PRIMARY KEY (cmd, image_key));
-            CREATE TABLE IF NOT EXISTS media.server_command_associations (
-                sid CHARACTER(19),
-                cmd TEXT REFERENCES media.commands(cmd) ON DELETE CASCADE,
-                PRIMARY KEY (sid, cmd));
-            CREATE TABLE IF NOT EXISTS media.aliases (
-                alias TEXT PRIMARY KEY,
-                real TEXT);
-            CREATE TABLE IF NOT EXISTS media.blacklist_associations (
-                cmd TEXT REFERENCES media.commands(cmd) ON DELETE CASCADE,
-                image_key TEXT,
-                uid CHARACTER(18),
-                PRIMARY KEY (cmd, image_key, uid));
-            """
+        self.cmd_index = CommandAliasIndex()
+        self.candidate_cache = CandidateImageCache(
+            functools.partial(self.bot.db.run, get_cmd_image_rows_from_db),
+            functools.partial(self.bot.db.run, get_user_blacklist),
         )
-        self.bot.db_connection.commit()
+        self.sampler = RandomImageSampler()
+        self.cmd_sizes = CommandSizeCounter()
+        self.phash_index = BKTree()
+        self.sent_messages_image_urls = dict()
+        self.catalog_synced = asyncio.Event()
+        """Set once the catalog has caught up with S3 after startup"""
+        self.sync_progress = "waiting to sync with S3"
 
-        collection_keys, collection_hashes = (
-            get_starting_keys_hashes(self.bot.s3_bucket)
-        )
-        sync_s3_db(self.bot.db_connection, collection_keys, collection_hashes)
+    async def cog_load(self):
+        # Serve whatever the database already has,
+        # and catch up with S3 in the background
+        await self.bot.db.run(create_media_tables)
+        await self.reload_catalog()
+        self.bot.command_fallbacks.append(self.resolve_image_command)
+        self.s3_reconciliation.start()
 
-        cascade_deleted_referenced_aliases(self.bot.db_connection)
+    def cog_unload(self):
+        self.bot.command_fallbacks.remove(self.resolve_image_command)
+        self.s3_reconciliation.cancel()
 
-        self.sent_messages_image_urls = dict()
+    async def reconcile_s3(self):
+        """Syncs the database with S3, and returns whether anything changed"""
+        self.sync_progress = "listing S3"
+        listing_started = discord.utils.utcnow() - S3_CLOCK_SKEW
+        contents = await asyncio.get_running_loop().run_in_executor(
+            None, list_s3_pictures, self.bot.s3_bucket)
+        self.sync_progress = f"syncing {len(contents)} S3 objects to the DB"
+        async with self.bot.db.transaction() as transaction:
+            sync_counts, stale_rendition_keys, unhashed_images = (
+                await transaction.run(
+                    reconcile_s3_db, contents, listing_started))
+            await transaction.run(cascade_deleted_referenced_aliases)
+        if stale_rendition_keys:
+            logger.info(f"Deleting stale renditions {stale_rendition_keys}")
+            await asyncio.get_running_loop().run_in_executor(
+                None, delete_s3_objects, self.bot.s3_bucket,
+                stale_rendition_keys)
+        picture_adder = self.bot.get_cog("PictureAdder")
+        if unhashed_images and picture_adder:
+            self.sync_progress = f"hashing {len(unhashed_images)} images"
+            try:
+                await picture_adder.hash_images(unhashed_images)
+            except Exception:
+                # The sync itself is committed, so the catalog still
+                # needs reloading; hashimages can catch these up later
+                logger.exception("Couldn't hash reconciled images")
+        self.sync_progress = (
+            f"last synced at {discord.utils.utcnow():%Y-%m-%d %H:%M} UTC "
+            f"({sync_counts})")
+        return any(sync_counts.values())
+
+    async def reload_catalog(self):
+        self.cmd_index = await self.bot.db.run(CommandAliasIndex.from_db)
+        self.sampler = await self.bot.db.run(RandomImageSampler.from_db)
+        self.cmd_sizes = await self.bot.db.run(CommandSizeCounter.from_db)
+        self.phash_index = await self.bot.db.run(BKTree.from_db)
+        self.candidate_cache.clear()
+
+    @property
+    def sync_status(self):
+        readiness = ("ready" if self.catalog_synced.is_set()
+                     else "warming up from the DB")
+        return f"{readiness}, {self.sync_progress}"
+
+    def resolve_image_command(self, invocation):
+        """
+        Command lookup fallback, so image commands and their aliases
+        are dispatched to send_image_func without being registered
+        """
+        if invocation in self.cmd_index:
+            return self.send_image_func
+        return None
+
+    @tasks.loop(minutes=S3_RECONCILE_INTERVAL)
+    async def s3_reconciliation(self):
+        """
+        Picks up images uploaded or deleted in S3 outside of the bot.
+        The first run is the startup sync.
+        """
+        try:
+            catalog_changed = await self.reconcile_s3()
+        except Exception as e:
+            logger.exception("Background S3 reconciliation failed")
+            self.sync_progress = f"last sync failed with {e!r}"
+            return
+        if catalog_changed:
+            logger.info("S3 changed, reloading the image catalog")
+            await self.reload_catalog()
+        self.catalog_synced.set()
+
+    def catalog_image_added(self, cmd, image_key, phash=None):
+        self.candidate_cache.invalidate_cmd(cmd)
+        self.sampler.add(cmd, image_key)
+        self.cmd_sizes.increment(cmd)
+        if phash is not None:
+            self.phash_index.add((cmd, image_key), phash)
+
+    def catalog_image_replaced(self, cmd, image_key, phash=None):
+        self.candidate_cache.invalidate_cmd(cmd)
+        self.phash_index.remove((cmd, image_key))
+        if phash is not None:
+            self.phash_index.add((cmd, image_key), phash)
+
+    def catalog_image_removed(self, cmd, image_key):
+        self.candidate_cache.invalidate_cmd(cmd)
+        self.sampler.remove(cmd, image_key)
+        self.cmd_sizes.decrement(cmd)
+        self.phash_index.remove((cmd, image_key))
+
+    def catalog_cmd_removed(self, cmd):
+        """Returns every invocation that pointed at cmd"""
+        self.candidate_cache.invalidate_cmd(cmd)
+        self.sampler.remove_cmd(cmd)
+        self.cmd_sizes.remove_cmd(cmd)
+        self.phash_index.remove_cmd(cmd)
+        return self.cmd_index.remove_cmd(cmd)
+
+    async def get_image_url(self, cmd, image_key):
+        """
+        Returns the URL to send for an image, which is its rendition's
+        if it has one, and whether that URL is an image
+        """
+        rendition = await self.candidate_cache.get_rendition(cmd, image_key)
+        if rendition:
+            rendition_key, rendition_content_type = rendition
+            s3_key = f"renditions/{cmd}/{rendition_key}"
+            is_image = util.content_type_is_image(rendition_content_type)
+        else:
+            s3_key = f"pictures/{cmd}/{image_key}"
+            is_image = await self.candidate_cache.is_image(cmd, image_key)
+        url = util.url_from_s3_key(
+            self.bot.s3_bucket, self.bot.s3_bucket_location, s3_key,
+            improve=True)
+        return url, is_image
+
+    async def send_image_url(self, ctx, url, is_image, call_bot_name=False):
+        """
+        Sends an embed for images. Anything else, like a GIF's MP4
+        rendition, is sent as a URL with the embed's phrase above it.
+        """
+        if is_image:
+            image_embed = await generate_image_embed(
+                ctx, url, call_bot_name=call_bot_name)
+            sent_message = await ctx.send(embed=image_embed)
+        else:
+            logger.info(f"{url} isn't an image, so sending as text URL")
+            video_message = await generate_video_message(
+                ctx, url, call_bot_name=call_bot_name)
+            # Mentions in an embed don't ping, so these shouldn't either
+            sent_message = await ctx.send(
+                video_message,
+                allowed_mentions=discord.AllowedMentions.none())
+        self.sent_messages_image_urls[sent_message.id] = url
 
     @commands.command(aliases=["yo", "hey", "makubot"])
     async def randomimage(self, ctx):
         """Get a totally random image!"""
-        chosen_path = get_random_image(self.bot.db_connection)
-        chosen_url = util.url_from_s3_key(
-            self.bot.s3_bucket,
-            self.bot.s3_bucket_location,
-            chosen_path,
-            improve=True)
+        if not self.sampler:
+            await ctx.send("I don't have any images yet! "
+                           "Give me a moment if I just woke up.")
+            return
+        chosen_cmd, chosen_key = self.sampler.choice()
+        chosen_url, is_image = await self.get_image_url(
+            chosen_cmd, chosen_key)
         logging.info(f"Sending url in randomimage func: {chosen_url}")
-        image_embed = await generate_image_embed(
-            ctx, chosen_url, call_bot_name=True)
-        sent_message = await ctx.send(embed=image_embed)
-        self.sent_messages_image_urls[sent_message.id] = chosen_url
-        if not await util.url_is_image(chosen_url):
-            new_url = util.improve_url(chosen_url)
-            logger.info(
-                "URL wasn't image, so turned to text URL. "
-                f"{chosen_url} -> {new_url}")
-            await sent_message.edit(embed=None, content=new_url)
+        await self.send_image_url(
+            ctx, chosen_url, is_image, call_bot_name=True)
 
     @commands.command(hidden=True)
     async def send_image_func(self, ctx):
@@ -471,7 +1047,7 @@ class ReactionImages(discord.ext.commands.Cog):
             await ctx.send("Nice try, fucker")
             return
         invoked_command = ctx.invoked_with.lower()
-        cmd = get_cmd_from_alias(ctx.bot.db_connection, invoked_command)
+        cmd = self.cmd_index.resolve(invoked_command)
         uid = ctx.author.id
         try:
             sid = ctx.guild.id
@@ -480,33 +1056,15 @@ class ReactionImages(discord.ext.commands.Cog):
         # cmd_uid = get_cmd_uid(ctx.bot.db_connection, cmd)
         # if cmd_uid == uid and sid:
         #     add_server_command_association(ctx.bot.db_connection, sid, cmd)
-        user_sids = get_user_sids(ctx.bot, uid)
-        user_origin_server_intersection = get_user_origin_server_intersection(
-            ctx.bot.db_connection, user_sids, cmd)
-        candidate_images = get_appropriate_images(
-            ctx.bot.db_connection, cmd, uid, sid,
-            user_origin_server_intersection)
-        logger.info(f"From {cmd=}, {uid=}, {sid=}, "
-                    f"{user_origin_server_intersection=}, got "
-                    f"{candidate_images=}")
-        chosen_key = random.choice(candidate_images)
-        if img_sid_should_be_set(ctx.bot.db_connection, cmd, chosen_key, uid):
-            logger.info(f"{cmd}'s sid will be set to {sid}")
-            set_img_sid(ctx.bot.db_connection, cmd, chosen_key, sid)
-        chosen_path = f"pictures/{cmd}/{chosen_key}"
-        chosen_url = util.url_from_s3_key(
-            ctx.bot.s3_bucket, ctx.bot.s3_bucket_location, chosen_path,
-            improve=True)
+        chosen_key = await self.candidate_cache.pick(cmd, uid)
+        logger.info(f"From {cmd=}, {uid=}, {sid=}, got {chosen_key=}")
+        if sid and await self.candidate_cache.claim_sid_stamp(
+                cmd, chosen_key, uid):
+            logger.info(f"{cmd}/{chosen_key}'s sid will be set to {sid}")
+            await self.bot.db.run(stamp_img_sid, cmd, chosen_key, uid, sid)
+        chosen_url, is_image = await self.get_image_url(cmd, chosen_key)
         logging.info(f"Sending url in send_image func: {chosen_url}")
-        image_embed = await generate_image_embed(ctx, chosen_url)
-        sent_message = await ctx.send(embed=image_embed)
-        self.sent_messages_image_urls[sent_message.id] = chosen_url
-        if not await util.url_is_image(chosen_url):
-            new_url = util.improve_url(chosen_url)
-            logger.info(
-                "URL wasn't image, so turned to text URL. "
-                f"{chosen_url} -> {new_url}")
-            await sent_message.edit(embed=None, content=new_url)
+        await self.send_image_url(ctx, chosen_url, is_image)
 
     @commands.command()
     async def showimage(self, ctx, cmdimgpath):
@@ -517,11 +1075,12 @@ class ReactionImages(discord.ext.commands.Cog):
             await ctx.send(
                 "Please use the form cmd/img, eg lupo/happy.jpg")
             return
-        cmd = get_cmd_from_alias(self.bot.db_connection, cmd)
+        cmd = self.cmd_index.resolve(cmd)
         if not cmd:
             await ctx.send("That isn't an image command :?")
             return
-        if not image_exists_in_cmd(self.bot.db_connection, image_key, cmd):
+        image_info_dict = await self.bot.db.run(image_info, cmd, image_key)
+        if not image_info_dict:
             await ctx.send("I can't find that image :?")
             return
         chosen_path = f"pictures/{cmd}/{image_key}"
@@ -529,15 +1088,9 @@ class ReactionImages(discord.ext.commands.Cog):
             ctx.bot.s3_bucket, ctx.bot.s3_bucket_location, chosen_path,
             improve=True)
         logging.info(f"Sending url in showimage func: {chosen_url}")
-        image_embed = await generate_image_embed(ctx, chosen_url)
-        sent_message = await ctx.send(embed=image_embed)
-        self.sent_messages_image_urls[sent_message.id] = chosen_url
-        if not await util.url_is_image(chosen_url):
-            new_url = util.improve_url(chosen_url)
-            logger.info(
-                "URL wasn't image, so turned to text URL. "
-                f"{chosen_url} -> {new_url}")
-            await sent_message.edit(embed=None, content=new_url)
+        await self.send_image_url(
+            ctx, chosen_url,
+            util.content_type_is_image(image_info_dict["content_type"]))
 
     @commands.command(hidden=True)
     async def whatwassentin(self, ctx, message: discord.Message):
@@ -550,15 +1103,14 @@ class ReactionImages(discord.ext.commands.Cog):
     @commands.command(aliases=["listimagecommands"])
     async def listreactions(self, ctx):
         """List all my reactions (image commands)"""
-        all_invocations = get_all_cmds_aliases_from_db(self.bot.db_connection)
+        all_invocations = self.cmd_index.invocations()
         all_invocations_alphabetized = sorted(all_invocations)
         pictures_desc = ", ".join(all_invocations_alphabetized)
         await util.displaytxt(ctx, pictures_desc)
 
     @commands.command(hidden=True, aliases=["realinvocation"])
     async def real_invocation(self, ctx, alias):
-        real_cmd = get_cmd_from_alias(
-            self.bot.db_connection, alias)
+        real_cmd = self.cmd_index.resolve(alias)
         if real_cmd == alias:
             await ctx.send(f"{real_cmd} is the actual function!")
         if real_cmd:
@@ -569,22 +1121,21 @@ class ReactionImages(discord.ext.commands.Cog):
     @commands.command()
     async def howbig(self, ctx, cmd):
         """Tells you how many images are in a command"""
-        real_cmd = get_cmd_from_alias(self.bot.db_connection, cmd)
+        real_cmd = self.cmd_index.resolve(cmd)
         if not real_cmd:
             await ctx.send(f"{cmd} isn't an image command :o")
             return
-        cmd_sizes = get_cmd_sizes(self.bot.db_connection)
-        cmd_size = cmd_sizes[real_cmd]
+        cmd_size = self.cmd_sizes.size(real_cmd)
         image_plurality = "image" if cmd_size == 1 else "images"
         base_size_msg = f"{cmd} has {cmd_size} {image_plurality}!"
         if not ctx.guild:
             await ctx.send(base_size_msg)
             return
         uid = ctx.author.id
-        user_sids = get_user_sids(self.bot, uid)
-        sid = ctx.guild.id
-        cmd_size_server, cmd_size_user = get_cmd_size_server_user(
-            self.bot.db_connection, real_cmd, uid, sid, user_sids)
+        cmd_size_server = len(
+            await self.candidate_cache.get_cmd_keys(real_cmd))
+        cmd_size_user = len(
+            await self.candidate_cache.get_candidates(real_cmd, uid))
         server_size_msg = (
             f"Anyone on the server can pull {cmd_size_server} of them!")
         user_size_msg = (
@@ -600,11 +1151,11 @@ class ReactionImages(discord.ext.commands.Cog):
     @commands.is_owner()
     @commands.command()
     async def deletecmd(self, ctx, cmd):
-        cmd = get_cmd_from_alias(self.bot.db_connection, cmd)
+        cmd = self.cmd_index.resolve(cmd)
         if not cmd:
             await ctx.send("That isn't an image command :?")
             return
-        cmd_info_dict = cmd_info(self.bot.db_connection, cmd)
+        cmd_info_dict = await self.bot.db.run(cmd_info, cmd)
         uid = cmd_info_dict["uid"]
         origin_sids = cmd_info_dict["origin_sids"]
         uid_user = self.bot.get_user(uid) if uid else None
@@ -618,20 +1169,14 @@ class ReactionImages(discord.ext.commands.Cog):
             f"Was at pictures/{cmd} "
             f"{uid_user_str=}, {origin_servers=}.")
 
-        cmd_aliases = get_cmd_aliases_from_db(self.bot.db_connection, cmd)
-        cmd_aliases.add(cmd)
-        delete_cmd_and_all_images(self.bot.db_connection, cmd)
-        cascade_deleted_referenced_aliases(self.bot.db_connection)
+        async with self.bot.db.transaction() as transaction:
+            await transaction.run(delete_cmd_and_all_images, cmd)
+            await transaction.run(cascade_deleted_referenced_aliases)
+        cmd_aliases = self.catalog_cmd_removed(cmd)
+        logger.info(f"Removed invocations {cmd_aliases}")
         cmd_bucket = boto3.resource('s3').Bucket(self.bot.s3_bucket)
-        cmd_bucket.objects.filter(Prefix=f"pictures/{cmd}").delete()
-        send_image_func_ref = self.bot.get_command("send_image_func")
-        self.bot.get_command("send_image_func").aliases = [
-            alias for alias in send_image_func_ref.aliases
-            if alias not in cmd_aliases
-        ]
-        for alias in cmd_aliases:
-            logger.info(f"Removing alias {alias}...")
-            self.bot.all_commands.pop(alias)
+        cmd_bucket.objects.filter(Prefix=f"pictures/{cmd}/").delete()
+        cmd_bucket.objects.filter(Prefix=f"renditions/{cmd}/").delete()
 
         await ctx.send(f"Command {cmd} deleted!")
 
@@ -644,12 +1189,12 @@ class ReactionImages(discord.ext.commands.Cog):
             await ctx.send(
                 "Please use the form cmd/img, eg lupo/happy.jpg")
             return
-        cmd = get_cmd_from_alias(self.bot.db_connection, cmd)
+        cmd = self.cmd_index.resolve(cmd)
         if not cmd:
             await ctx.send("That isn't an image command :?")
             return
-        image_info_dict = image_info(
-            self.bot.db_connection, cmd, image_key)
+        image_info_dict = await self.bot.db.run(
+            image_info, cmd, image_key)
         if not image_info_dict:
             await ctx.send("I can't find that image :?")
             return
@@ -668,53 +1213,46 @@ class ReactionImages(discord.ext.commands.Cog):
             f"{uid_user_str=}, {sid_server_str=}, {md5=}.")
         full_image_key = f"pictures/{cmd}/{image_key}"
 
-        delete_image_from_db(self.bot.db_connection, cmd, image_key)
+        await self.bot.db.run(delete_image_from_db, cmd, image_key)
+        self.catalog_image_removed(cmd, image_key)
 
         S3.delete_object(
             Bucket=self.bot.s3_bucket,
             Key=full_image_key
         )
+        if image_info_dict.get("rendition_key"):
+            S3.delete_object(
+                Bucket=self.bot.s3_bucket,
+                Key=f"renditions/{cmd}/{image_info_dict['rendition_key']}"
+            )
         await ctx.send("Image deleted!")
 
-        images_remaining = get_all_cmd_images_from_db(
-            self.bot.db_connection, cmd)
+        async with self.bot.db.transaction() as transaction:
+            images_remaining = await transaction.run(
+                get_all_cmd_images_from_db, cmd)
+            if not images_remaining:
+                await transaction.run(delete_cmd_and_all_images, cmd)
+                await transaction.run(cascade_deleted_referenced_aliases)
         if not images_remaining:
-            cmd_aliases = get_cmd_aliases_from_db(self.bot.db_connection, cmd)
-            cmd_aliases.add(cmd)
-            delete_cmd_and_all_images(self.bot.db_connection, cmd)
-            cascade_deleted_referenced_aliases(self.bot.db_connection)
-            send_image_func_ref = self.bot.get_command("send_image_func")
-            self.bot.get_command("send_image_func").aliases = [
-                alias for alias in send_image_func_ref.aliases
-                if alias not in cmd_aliases
-            ]
-            for alias in cmd_aliases:
-                logger.info(f"Removing alias {alias}...")
-                self.bot.all_commands.pop(alias)
+            cmd_aliases = self.catalog_cmd_removed(cmd)
+            logger.info(f"Removed invocations {cmd_aliases}")
             await ctx.send("Also deleted command, as it is now empty.")
 
     @commands.command(aliases=["topten"])
     async def bigten(self, ctx):
         """List my ten biggest image commands!"""
-        command_sizes = get_cmd_sizes(self.bot.db_connection)
-        commands_sorted = sorted(
-            command_sizes.keys(),
-            key=lambda command: command_sizes[command],
-            reverse=True
-        )
-        top_ten_commands = commands_sorted[:10]
         message = "\n".join([
-            f"{command}: {command_sizes[command]}"
-            for command in top_ten_commands])
+            f"{command}: {command_size}"
+            for command, command_size in self.cmd_sizes.top()])
         await ctx.send(message)
 
     @commands.command(hidden=True, aliases=["getcmdinfo"])
     async def get_cmd_info(self, ctx, cmd):
-        real_cmd = get_cmd_from_alias(self.bot.db_connection, cmd)
+        real_cmd = self.cmd_index.resolve(cmd)
         if not real_cmd:
             await ctx.send("That's not an image command :?")
             return
-        cmd_info_dict = cmd_info(self.bot.db_connection, real_cmd)
+        cmd_info_dict = await self.bot.db.run(cmd_info, real_cmd)
         uid = cmd_info_dict["uid"]
         origin_sids = cmd_info_dict["origin_sids"]
         uid_user = self.bot.get_user(uid)
@@ -738,12 +1276,12 @@ class ReactionImages(discord.ext.commands.Cog):
             await ctx.send(
                 "Please use the form cmd/img, eg lupo/happy.jpg")
             return
-        real_cmd = get_cmd_from_alias(self.bot.db_connection, cmd)
+        real_cmd = self.cmd_index.resolve(cmd)
         if not real_cmd:
             await ctx.send("That isn't an image command :?")
             return
-        image_info_dict = image_info(
-            self.bot.db_connection, real_cmd, image_key)
+        image_info_dict = await self.bot.db.run(
+            image_info, real_cmd, image_key)
         if not image_info_dict:
             await ctx.send("I can't find that image :?")
             return
@@ -764,33 +1302,33 @@ class ReactionImages(discord.ext.commands.Cog):
     @commands.command(hidden=True, aliases=["setcmdowner"])
     async def set_cmd_images_owner(self, ctx, cmd, user: discord.User):
         uid = user.id
-        cmd = get_cmd_from_alias(self.bot.db_connection, cmd)
+        cmd = self.cmd_index.resolve(cmd)
         if not cmd:
             await ctx.send("That's not an image command :?")
             return
-        set_cmd_images_owner_on_db(self.bot.db_connection, cmd, uid)
+        await self.bot.db.run(set_cmd_images_owner_on_db, cmd, uid)
         await ctx.send("Done!")
 
     @commands.is_owner()
     @commands.command(hidden=True, aliases=["setcmdserver"])
     async def set_cmd_images_server(self, ctx, cmd, sid):
         assert len(sid) in [18, 19]
-        cmd = get_cmd_from_alias(self.bot.db_connection, cmd)
+        cmd = self.cmd_index.resolve(cmd)
         if not cmd:
             await ctx.send("That's not an image command :?")
             return
-        set_cmd_images_server_on_db(self.bot.db_connection, cmd, sid)
+        await self.bot.db.run(set_cmd_images_server_on_db, cmd, sid)
         await ctx.send("Done!")
 
     @commands.command(hidden=True)
     async def imagesin(self, ctx, cmd):
         """Shows you all images in a command. Extremely spammy."""
-        cmd = get_cmd_from_alias(self.bot.db_connection, cmd)
+        cmd = self.cmd_index.resolve(cmd)
         if not cmd:
             await ctx.send("That's not an image command :?")
             return
-        images = get_all_cmd_images_from_db(
-            self.bot.db_connection, cmd)
+        images = await self.bot.db.run(
+            get_all_cmd_images_from_db, cmd)
         image_paths = [f"pictures/{cmd}/{image_key}" for image_key in images]
         image_urls = [
             util.url_from_s3_key(
@@ -813,8 +1351,8 @@ class ReactionImages(discord.ext.commands.Cog):
         """
         if ctx.invoked_subcommand is not None:
             return
-        cmd_image_pairs = get_user_blacklist(
-            self.bot.db_connection, ctx.author.id)
+        cmd_image_pairs = await self.bot.db.run(
+            get_user_blacklist, ctx.author.id)
         if not cmd_image_pairs:
             await ctx.send("Looks like you haven't blacklisted any images!")
             return
@@ -835,14 +1373,15 @@ class ReactionImages(discord.ext.commands.Cog):
             await ctx.send(
                 "Hmm, I can't tell what the command/key combination is!")
             return
-        cmd = get_cmd_from_alias(self.bot.db_connection, cmd)
+        cmd = self.cmd_index.resolve(cmd)
         if not cmd:
             await ctx.send("That's not an image command :?")
             return
-        if not image_exists_in_cmd(self.bot.db_connection, image_key, cmd):
+        if not await self.bot.db.run(image_exists_in_cmd, image_key, cmd):
             await ctx.send("I can't find that image :?")
             return
-        add_blacklist_association(self.bot.db_connection, cmd, image_key, uid)
+        await self.bot.db.run(add_blacklist_association, cmd, image_key, uid)
+        self.candidate_cache.invalidate_user(uid)
         await ctx.send("Done!")
 
     @imageblacklist.command()
@@ -858,15 +1397,16 @@ class ReactionImages(discord.ext.commands.Cog):
             await ctx.send(
                 "Hmm, I can't tell what the command/key combination is!")
             return
-        cmd = get_cmd_from_alias(self.bot.db_connection, cmd)
+        cmd = self.cmd_index.resolve(cmd)
         if not cmd:
             await ctx.send("That's not an image command :?")
             return
-        if not image_exists_in_cmd(self.bot.db_connection, image_key, cmd):
+        if not await self.bot.db.run(image_exists_in_cmd, image_key, cmd):
             await ctx.send("I can't find that image :?")
             return
-        remove_blacklist_association(
-            self.bot.db_connection, cmd, image_key, uid)
+        await self.bot.db.run(
+            remove_blacklist_association, cmd, image_key, uid)
+        self.candidate_cache.invalidate_user(uid)
         await ctx.send("Sure!")
 
     @commands.command(hidden=True)
@@ -882,11 +1422,4 @@ async def setup(bot):
     logger.info("picturecommands starting setup")
     await bot.add_cog(ReactionImages(bot))
     await bot.add_cog(PictureAdder(bot))
-    image_command_invocations = list(
-        get_all_cmds_aliases_from_db(bot.db_connection))
-
-    bot.get_command("send_image_func").aliases += image_command_invocations
-    for invocation in image_command_invocations:
-        bot.all_commands[invocation] = bot.all_commands["send_image_func"]
-
     logger.info("picturecommands ending setup")
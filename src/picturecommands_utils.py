@@ -1,11 +1,22 @@
 import discord
 import logging
 import os
+import sys
+import random
+import collections
+import heapq
+import operator
+import itertools
 import asyncio
+import time
 import concurrent
-import subprocess
 import youtube_dl
 import tempfile
+import json
+import functools
+import aiohttp
+from PIL import Image, ImageOps
+import psycopg2.extras
 from psycopg2.extras import RealDictCursor
 import boto3
 from . import util
@@ -17,6 +28,46 @@ NO_EMOJI, YES_EMOJI = "❌", "✅"
 
 S3 = boto3.client("s3")
 
+S3_LIST_CONCURRENCY = 16
+
+DOWNLOAD_WORKERS = 4
+TRANSCODE_CONCURRENCY = os.cpu_count() or 1
+TRANSCODE_TIMEOUT = 10 * 60  # seconds
+MAX_VIDEO_SIZE = 32e6  # bits. Technically 64e6 but there's some error.
+# Remux extension to the codecs that container can hold and Discord can play
+PLAYABLE_CODECS = {
+    ".mp4": ({"h264"}, {"aac", "mp3"}),
+    ".webm": ({"vp8", "vp9"}, {"opus", "vorbis"}),
+}
+# Extension that can be passed through to the ffprobe demuxer it has to be
+# (format_name lists several) and the PLAYABLE_CODECS its streams must fit
+PLAYABLE_EXTENSIONS = {
+    ".mp4": ("mp4", ".mp4"),
+    ".mov": ("mov", ".mp4"),
+    ".mp3": ("mp3", ".mp4"),
+    ".webm": ("webm", ".webm"),
+    ".ogg": ("ogg", ".webm"),
+}
+IMAGE_CODECS = {"gif", "apng", "webp", "png", "mjpeg"}
+# (max height, max fps) to try, best first, when a video has to be encoded
+ENCODING_LADDER = [
+    (1080, 30),
+    (720, 30),
+    (480, 30),
+    (360, 24),
+    (240, 15),
+]
+# Below this many video bits per pixel per frame, H.264 looks like mush
+MIN_BITS_PER_PIXEL = 0.04
+IMAGE_WORKERS = os.cpu_count() or 1
+MAX_VARIANT_DIMENSION = 1600  # pixels, about as big as an embed ever shows
+PHASH_SIZE = 8  # dHash grid width, so hashes are PHASH_SIZE ** 2 bits
+NEAR_DUPLICATE_DISTANCE = 10  # bits out of 64
+# Pillow formats worth recompressing, and what to save them as
+VARIANT_FORMATS = {"PNG": "PNG", "JPEG": "JPEG", "WEBP": "WEBP",
+                   "BMP": "PNG", "TIFF": "PNG"}
+MAX_DOWNLOAD_SIZE = 64 * 1024 * 1024  # bytes
+
 INTERACTION_CMDS = {
     "hug": "{receiver}, you got a hug from {sender}!",
     "kiss": "{receiver}, you got kissed by {sender}!",
@@ -30,6 +81,14 @@ class NotVideo(Exception):
     pass
 
 
+class MediaTooLarge(Exception):
+    pass
+
+
+class QualityTooLow(Exception):
+    pass
+
+
 def as_text(value):
     """
     Tries to turn a value which might have come as a string (IDs and such)
@@ -88,7 +147,6 @@ def set_cmd_images_owner_on_db(db_connection, cmd, uid):
         """,
         (uid, cmd)
     )
-    db_connection.commit()
 
 
 def set_cmd_images_server_on_db(db_connection, cmd, sid):
@@ -102,7 +160,6 @@ def set_cmd_images_server_on_db(db_connection, cmd, sid):
         """,
         (sid, cmd)
     )
-    db_connection.commit()
 
 
 def add_alias_to_db(db_connection, alias, real):
@@ -116,7 +173,6 @@ def add_alias_to_db(db_connection, alias, real):
             """,
         (alias, real)
     )
-    db_connection.commit()
 
 
 def cmd_info(db_connection, cmd):
@@ -179,7 +235,13 @@ def image_exists_in_cmd(db_connection, image_key, cmd):
 
 
 def add_image_to_db(
-        db_connection, image_key, cmd, uid=None, sid=None, md5=None):
+        db_connection, image_key, cmd, uid=None, sid=None, md5=None,
+        content_type=None, size=None, rendition_key=None,
+        rendition_content_type=None, rendition_size=None, phash=None):
+    """
+    Also claims the row if an S3 sync already inserted it,
+    since the sync can see the upload before this runs
+    """
     uid = as_text(uid)
     sid = as_text(sid)
     md5 = as_text(md5)
@@ -191,12 +253,80 @@ def add_image_to_db(
         image_key,
         uid,
         sid,
-        md5)
-        VALUES (%s, %s, %s, %s, %s);
+        md5,
+        content_type,
+        size,
+        rendition_key,
+        rendition_content_type,
+        rendition_size,
+        phash)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (cmd, image_key) DO UPDATE
+        SET uid = EXCLUDED.uid,
+            sid = EXCLUDED.sid,
+            md5 = EXCLUDED.md5,
+            content_type = EXCLUDED.content_type,
+            size = EXCLUDED.size,
+            rendition_key = EXCLUDED.rendition_key,
+            rendition_content_type = EXCLUDED.rendition_content_type,
+            rendition_size = EXCLUDED.rendition_size,
+            phash = EXCLUDED.phash,
+            added_at = now();
+        """,
+        (cmd, image_key, uid, sid, md5, content_type, size,
+         rendition_key, rendition_content_type, rendition_size,
+         phash_to_db(phash))
+    )
+
+
+def phash_to_db(phash):
+    """Hashes are unsigned 64 bit, but Postgres only has signed BIGINT"""
+    if phash is None or phash < 1 << 63:
+        return phash
+    return phash - (1 << 64)
+
+
+def phash_from_db(phash):
+    if phash is None:
+        return None
+    return phash & ((1 << 64) - 1)
+
+
+def get_all_image_phashes_from_db(db_connection):
+    cursor = db_connection.cursor()
+    cursor.execute(
+        """
+        SELECT cmd, image_key, phash FROM media.images
+        WHERE phash IS NOT NULL
+        """
+    )
+    return [(cmd, image_key, phash_from_db(phash))
+            for cmd, image_key, phash in cursor.fetchall()]
+
+
+def get_unhashed_images_from_db(db_connection):
+    cursor = db_connection.cursor()
+    cursor.execute(
+        """
+        SELECT cmd, image_key FROM media.images
+        WHERE phash IS NULL
+        AND (content_type LIKE 'image/%%' OR content_type IS NULL)
+        """
+    )
+    return cursor.fetchall()
+
+
+def set_image_phash_in_db(db_connection, cmd, image_key, phash):
+    cursor = db_connection.cursor()
+    cursor.execute(
+        """
+        UPDATE media.images
+        SET phash = %s
+        WHERE cmd = %s
+        AND image_key = %s
         """,
-        (cmd, image_key, uid, sid, md5)
+        (phash_to_db(phash), cmd, image_key)
     )
-    db_connection.commit()
 
 
 def command_exists_in_db(db_connection, cmd):
@@ -221,7 +351,9 @@ def add_cmd_to_db(db_connection, cmd, uid=None, sid=None):
         INSERT INTO media.commands (
         cmd,
         uid)
-        VALUES (%s, %s);
+        VALUES (%s, %s)
+        ON CONFLICT (cmd) DO UPDATE
+        SET uid = COALESCE(media.commands.uid, EXCLUDED.uid);
         """,
         (cmd, uid)
     )
@@ -235,7 +367,6 @@ def add_cmd_to_db(db_connection, cmd, uid=None, sid=None):
             """,
             (cmd, sid)
         )
-    db_connection.commit()
 
 
 def delete_image_from_db(db_connection, cmd, image_key):
@@ -249,7 +380,6 @@ def delete_image_from_db(db_connection, cmd, image_key):
         """,
         (cmd, image_key)
     )
-    db_connection.commit()
 
 
 def cascade_deleted_referenced_aliases(db_connection):
@@ -267,7 +397,6 @@ def cascade_deleted_referenced_aliases(db_connection):
     results = cursor.fetchall()
     formatted_results = as_ids(results)
     logger.info(f"Deleted old aliases: {formatted_results}")
-    db_connection.commit()
 
 
 def delete_cmd_and_all_images(db_connection, cmd):
@@ -292,22 +421,65 @@ def delete_cmd_and_all_images(db_connection, cmd):
     results = cursor.fetchall()
     formatted_results = as_ids(results)
     logger.info(f"Deleted cmd and images: {formatted_results}")
-    db_connection.commit()
 
 
-def get_random_image(db_connection):
-    cursor = db_connection.cursor(cursor_factory=RealDictCursor)
+def get_all_cmd_image_pairs_from_db(db_connection):
+    cursor = db_connection.cursor()
     cursor.execute(
         """
-        SELECT * FROM media.images
-        ORDER BY RANDOM()
-        LIMIT 1
+        SELECT cmd, image_key FROM media.images
         """
     )
-    result = cursor.fetchone()
-    result_cmd = result["cmd"]
-    result_image_key = result["image_key"]
-    return f"pictures/{result_cmd}/{result_image_key}"
+    return cursor.fetchall()
+
+
+class RandomImageSampler:
+    """
+    Every (cmd, image_key) pair in a dense list, so picking a uniformly
+    random image is one random index regardless of catalog size.
+    Removing swaps the last pair into the gap to keep the list dense.
+    """
+
+    def __init__(self, cmd_image_pairs=()):
+        self.pairs = []
+        self.positions = {}
+        """Maps (cmd, image_key) to its index in pairs"""
+        for cmd, image_key in cmd_image_pairs:
+            self.add(cmd, image_key)
+
+    @classmethod
+    def from_db(cls, db_connection):
+        return cls(get_all_cmd_image_pairs_from_db(db_connection))
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def add(self, cmd, image_key):
+        pair = (cmd, sys.intern(image_key))
+        if pair in self.positions:
+            return
+        self.positions[pair] = len(self.pairs)
+        self.pairs.append(pair)
+
+    def remove(self, cmd, image_key):
+        position = self.positions.pop((cmd, image_key), None)
+        if position is None:
+            return
+        last_pair = self.pairs.pop()
+        if position < len(self.pairs):
+            self.pairs[position] = last_pair
+            self.positions[last_pair] = position
+
+    def remove_cmd(self, cmd):
+        for pair_cmd, image_key in [
+                pair for pair in self.pairs if pair[0] == cmd]:
+            self.remove(pair_cmd, image_key)
+
+    def choice(self):
+        """Returns a random (cmd, image_key), or None if there are none"""
+        if not self.pairs:
+            return None
+        return random.choice(self.pairs)
 
 
 def get_cmd_sizes(db_connection):
@@ -323,16 +495,147 @@ def get_cmd_sizes(db_connection):
     return {result["cmd"]: result["cmd_size"] for result in results}
 
 
-def get_cmd_size_server_user(db_connection, cmd, uid, sid, user_sids):
-    uid = as_text(uid)
-    sid = as_text(sid)
-    user_sids = as_text(user_sids)
-    fake_uid = "0"*18
-    appropriate_images_server = get_appropriate_images(
-        db_connection, cmd, fake_uid, sid)
-    appropriate_images_user = get_appropriate_images(
-        db_connection, cmd, uid, sid, user_sids)
-    return len(appropriate_images_server), len(appropriate_images_user)
+class CommandSizeCounter:
+    """
+    Number of images in each cmd, kept up to date as images are added
+    and removed, plus a cached top-k that's only rebuilt when a change
+    could actually affect it.
+    """
+
+    def __init__(self, cmd_sizes=None, top_k=10):
+        self.cmd_sizes = dict(cmd_sizes or {})
+        self.top_k = top_k
+        self.top_cmds = None
+        """Cached [(cmd, size)] of the biggest cmds, or None if stale"""
+
+    @classmethod
+    def from_db(cls, db_connection):
+        return cls(get_cmd_sizes(db_connection))
+
+    def size(self, cmd):
+        return self.cmd_sizes.get(cmd, 0)
+
+    def affects_top(self, cmd, new_size):
+        if self.top_cmds is None:
+            return False
+        if len(self.top_cmds) < self.top_k:
+            return True
+        return (cmd in dict(self.top_cmds)
+                or new_size >= self.top_cmds[-1][1])
+
+    def increment(self, cmd):
+        new_size = self.size(cmd) + 1
+        self.cmd_sizes[cmd] = new_size
+        if self.affects_top(cmd, new_size):
+            self.top_cmds = None
+
+    def decrement(self, cmd):
+        new_size = self.size(cmd) - 1
+        if new_size > 0:
+            self.cmd_sizes[cmd] = new_size
+        else:
+            self.cmd_sizes.pop(cmd, None)
+        if self.affects_top(cmd, new_size):
+            self.top_cmds = None
+
+    def remove_cmd(self, cmd):
+        self.cmd_sizes.pop(cmd, None)
+        if self.top_cmds is not None and cmd in dict(self.top_cmds):
+            self.top_cmds = None
+
+    def top(self):
+        """Returns [(cmd, size)] for the top_k biggest cmds, biggest first"""
+        if self.top_cmds is None:
+            self.top_cmds = heapq.nlargest(
+                self.top_k, self.cmd_sizes.items(),
+                key=operator.itemgetter(1))
+        return self.top_cmds
+
+
+def hamming_distance(first_hash, second_hash):
+    return bin(first_hash ^ second_hash).count("1")
+
+
+class BKTree:
+    """
+    Perceptual hashes of (cmd, image_key)s, indexed by Hamming distance.
+    Every child of a node sits at a known distance from it, so the triangle
+    inequality rules out most subtrees when searching for near hashes.
+    Removing only takes an item out of its node; the node stays to route
+    searches, and the tree is rebuilt along with the rest of the catalog.
+    """
+
+    def __init__(self, hashed_items=()):
+        self.root = None
+        """[phash, set of items, {distance: child node}]"""
+        self.hashes = {}
+        """Maps each item to its phash"""
+        for cmd, image_key, phash in hashed_items:
+            self.add((cmd, image_key), phash)
+
+    @classmethod
+    def from_db(cls, db_connection):
+        return cls(get_all_image_phashes_from_db(db_connection))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, item, phash):
+        self.remove(item)
+        self.hashes[item] = phash
+        if self.root is None:
+            self.root = [phash, {item}, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(phash, node[0])
+            if distance == 0:
+                node[1].add(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [phash, {item}, {}]
+                return
+            node = child
+
+    def find_node(self, phash):
+        node = self.root
+        while node is not None:
+            distance = hamming_distance(phash, node[0])
+            if distance == 0:
+                return node
+            node = node[2].get(distance)
+        return None
+
+    def remove(self, item):
+        phash = self.hashes.pop(item, None)
+        if phash is None:
+            return
+        node = self.find_node(phash)
+        if node is not None:
+            node[1].discard(item)
+
+    def remove_cmd(self, cmd):
+        for item in [item for item in self.hashes if item[0] == cmd]:
+            self.remove(item)
+
+    def search(self, phash, max_distance=NEAR_DUPLICATE_DISTANCE, cmd=None):
+        """
+        Returns [(distance, (cmd, image_key))] within max_distance of phash,
+        closest first, optionally only from cmd
+        """
+        matches = []
+        nodes_to_visit = [self.root] if self.root is not None else []
+        while nodes_to_visit:
+            node = nodes_to_visit.pop()
+            distance = hamming_distance(phash, node[0])
+            if distance <= max_distance:
+                matches.extend((distance, item) for item in node[1]
+                               if cmd is None or item[0] == cmd)
+            nodes_to_visit.extend(
+                child for child_distance, child in node[2].items()
+                if abs(child_distance - distance) <= max_distance)
+        return sorted(matches)
 
 
 def get_all_true_cmds_from_db(db_connection):
@@ -410,20 +713,6 @@ def get_all_cmds_aliases_from_db(db_connection):
     return normal_commands | alias_commands
 
 
-def get_cmd_aliases_from_db(db_connection, cmd):
-    cursor = db_connection.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        """
-        SELECT * FROM media.aliases
-        WHERE real = %s
-        """,
-        (cmd,)
-    )
-    results = cursor.fetchall()
-    alias_commands = {result["alias"] for result in results}
-    return alias_commands
-
-
 def cmd_has_hash(db_connection, cmd, md5):
     md5 = as_text(md5)
     cursor = db_connection.cursor(cursor_factory=RealDictCursor)
@@ -452,35 +741,72 @@ def get_all_cmd_images_from_db(db_connection, cmd):
     return [result["image_key"] for result in results]
 
 
-def get_cmd_from_alias(db_connection, alias_cmd):
-    alias_cmd = alias_cmd.lower()
+def get_all_aliases_from_db(db_connection):
     cursor = db_connection.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        """
-        SELECT * FROM media.commands
-        WHERE cmd = %s
-        """,
-        (alias_cmd,)
-    )
-    results = cursor.fetchall()
-    if results:
-        assert len(results) == 1
-        return results[0]["cmd"]
     cursor.execute(
         """
         SELECT * FROM media.aliases
-        WHERE alias = %s
-        """,
-        (alias_cmd,)
+        """
     )
     results = cursor.fetchall()
-    if not results:
-        logger.info(f"{alias_cmd} wasn't an alias or real, returning None")
-        return None
-    assert len(results) == 1
-    true_invocation = results[0]["real"]
-    logger.info(f"Resolved alias {alias_cmd} -> {true_invocation}")
-    return true_invocation
+    return {result["alias"]: result["real"] for result in results}
+
+
+class CommandAliasIndex:
+    """
+    In-memory mirror of media.commands and media.aliases,
+    so resolving an invocation doesn't need a database round trip.
+    It has to be kept up to date by whoever writes to those tables.
+    """
+
+    def __init__(self, cmds=(), aliases=None):
+        self.cmds = set(cmds)
+        self.aliases = dict(aliases or {})
+        """Maps alias to real cmd"""
+
+    @classmethod
+    def from_db(cls, db_connection):
+        return cls(
+            cmds=get_all_true_cmds_from_db(db_connection),
+            aliases=get_all_aliases_from_db(db_connection),
+        )
+
+    def __contains__(self, invocation):
+        return self.resolve(invocation) is not None
+
+    def __len__(self):
+        return len(self.cmds) + len(self.aliases)
+
+    def resolve(self, invocation):
+        """Returns the real cmd for an invocation, or None"""
+        invocation = invocation.lower()
+        if invocation in self.cmds:
+            return invocation
+        return self.aliases.get(invocation)
+
+    def invocations(self):
+        return self.cmds | set(self.aliases)
+
+    def aliases_of(self, cmd):
+        return {alias for alias, real in self.aliases.items() if real == cmd}
+
+    def add_cmd(self, cmd):
+        self.cmds.add(cmd)
+
+    def add_alias(self, alias, real):
+        self.aliases[alias] = real
+
+    def remove_cmd(self, cmd):
+        """
+        Removes a cmd along with the aliases pointing at it,
+        and returns every invocation that was removed
+        """
+        removed = self.aliases_of(cmd)
+        for alias in removed:
+            del self.aliases[alias]
+        self.cmds.discard(cmd)
+        removed.add(cmd)
+        return removed
 
 
 def get_cmd_uid(db_connection, cmd):
@@ -511,126 +837,173 @@ def add_server_command_association(db_connection, sid, cmd):
         """,
         (sid, cmd)
     )
-    db_connection.commit()
-
-
-def get_user_sids(bot, uid):
-    """Returns a set of servers that the user and the bot share"""
-    shared_servers = {bot_server for bot_server in bot.guilds
-                      if bot_server.get_member(uid)}
-    shared_sids = {shared_server.id for shared_server in shared_servers}
-    return shared_sids
-
-
-def get_user_origin_server_intersection(db_connection, user_sids, cmd):
-    user_sids = as_text(user_sids)
-    cursor = db_connection.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        """
-        SELECT * FROM media.server_command_associations
-        WHERE cmd = %s
-        AND sid = ANY(%s);
-        """,
-        (cmd, user_sids)
-    )
-    results = cursor.fetchall()
-    intersecting_sids = as_ids([result["sid"] for result in results])
-    return intersecting_sids
 
 
-def img_sid_should_be_set(db_connection, cmd, image_key, uid):
+def stamp_img_sid(db_connection, cmd, image_key, uid, sid):
+    """
+    Sets the image's sid if uid owns it and it has no sid yet.
+    Checks and sets in one statement; returns whether it was set.
+    """
     uid = as_text(uid)
+    sid = as_text(sid)
     cursor = db_connection.cursor(cursor_factory=RealDictCursor)
     cursor.execute(
         """
-        SELECT * FROM media.images
+        UPDATE media.images
+        SET sid = %s
         WHERE cmd = %s
-        AND image_key = %s;
+        AND image_key = %s
+        AND uid = %s
+        AND sid IS NULL
+        RETURNING image_key;
         """,
-        (cmd, image_key)
+        (sid, cmd, image_key, uid)
     )
     results = cursor.fetchall()
-    assert len(results) == 1
-    result = results[0]
-    img_uid = as_ids(result["uid"])
-    img_sid = as_ids(result["sid"])
-    should_set = (img_uid == as_ids(uid)) and img_sid is None
-    logger.info(
-        f"For {cmd=} {image_key=}, got {img_uid=}, {img_sid=}, {should_set=}")
-    return should_set
+    return bool(results)
 
 
-def set_img_sid(db_connection, cmd, image_key, sid):
-    sid = as_text(sid)
+def get_cmd_image_rows_from_db(db_connection, cmd):
     cursor = db_connection.cursor(cursor_factory=RealDictCursor)
     cursor.execute(
         """
-        UPDATE media.images
-        SET sid = %s
+        SELECT image_key, uid, sid, content_type,
+        rendition_key, rendition_content_type
+        FROM media.images
         WHERE cmd = %s
-        AND image_key = %s;
         """,
-        (sid, cmd, image_key)
+        (cmd,)
     )
-    db_connection.commit()
+    return cursor.fetchall()
 
 
-def get_appropriate_images(
-        db_connection,
-        cmd,
-        uid,
-        sid=None,
-        user_sids=[],
-        enable_insulation=False,
-        ):
-    uid = as_text(uid)
-    sid = as_text(sid)
-    user_sids = as_text(user_sids)
-    cursor = db_connection.cursor(cursor_factory=RealDictCursor)
-    if enable_insulation:
-        cursor.execute(
-            """
-            SELECT * FROM media.images
-            WHERE cmd = %s
-            AND (uid IS NULL OR uid = %s OR sid = %s OR sid = ANY(%s))
-            AND image_key NOT IN (
-                SELECT image_key
-                FROM media.blacklist_associations
-                WHERE uid = %s
-                AND cmd = %s
-            );
-            """,
-            (cmd, uid, sid, user_sids, uid, cmd)
-        )
-    else:
-        cursor.execute(
-            """
-            SELECT * FROM media.images
-            WHERE cmd = %s
-            AND image_key NOT IN (
-                SELECT image_key
-                FROM media.blacklist_associations
-                WHERE uid = %s
-                AND cmd = %s
-            );
-            """,
-            (cmd, uid, cmd)
-        )
-    results = cursor.fetchall()
-    if results:
-        return [result["image_key"] for result in results]
-    logger.info(
-        f"Couldn't get any appropriate images for {cmd=} {uid=} {sid=} "
-        f"{user_sids=}, so pulling from the entire collection")
-    cursor.execute(
+class CandidateImageCache:
+    """
+    Per-command image keys and per-user blacklists held in memory,
+    so picking an image doesn't pull a whole collection over the wire.
+    Entries are loaded lazily through the given (async) loaders and have to
+    be invalidated whenever the images or blacklist tables change.
+    A send costs one round trip per loader that misses, plus one if the
+    picked image needs its sid stamped, so at most three when cold.
+    """
+
+    def __init__(self, load_cmd_images, load_user_blacklist,
+                 max_users=10000):
+        self.load_cmd_images = load_cmd_images
+        """Takes a cmd and returns its image rows (image_key, uid, sid,
+        content_type, rendition_key, rendition_content_type)"""
+        self.load_user_blacklist = load_user_blacklist
+        """Takes a uid and returns (cmd, image_key) pairs"""
+        self.max_users = max_users
+        self.cmd_keys = {}
+        """Maps cmd to a tuple of interned image keys"""
+        self.unstamped = {}
+        """Maps cmd to {image_key: owner uid} for owned images with no sid"""
+        self.non_images = {}
+        """Maps cmd to the set of its keys that can't be shown in an embed"""
+        self.renditions = {}
+        """Maps cmd to {image_key: (rendition_key, rendition_content_type)}
+        for images that have a smaller rendition to send instead"""
+        self.user_blacklists = collections.OrderedDict()
+        """Maps uid to {cmd: set of blacklisted image keys}, LRU ordered"""
+
+    async def get_cmd_keys(self, cmd):
+        if cmd not in self.cmd_keys:
+            rows = await self.load_cmd_images(cmd)
+            self.cmd_keys[cmd] = tuple(
+                sys.intern(row["image_key"]) for row in rows)
+            self.unstamped[cmd] = {
+                row["image_key"]: as_ids(row["uid"]) for row in rows
+                if row["uid"] is not None and row["sid"] is None}
+            # Rows from before content_type was recorded are NULL until
+            # the S3 sync backfills them, so guess like the backfill does
+            self.non_images[cmd] = {
+                row["image_key"] for row in rows
+                if not util.content_type_is_image(
+                    row["content_type"]
+                    or util.guess_content_type(row["image_key"]))}
+            self.renditions[cmd] = {
+                row["image_key"]: (row["rendition_key"],
+                                   row["rendition_content_type"])
+                for row in rows if row["rendition_key"] is not None}
+        return self.cmd_keys[cmd]
+
+    async def get_blacklisted(self, uid, cmd):
+        uid = as_ids(uid)
+        if uid in self.user_blacklists:
+            self.user_blacklists.move_to_end(uid)
+        else:
+            blacklist = collections.defaultdict(set)
+            for blacklisted_cmd, image_key in await self.load_user_blacklist(
+                    uid):
+                blacklist[blacklisted_cmd].add(sys.intern(image_key))
+            self.user_blacklists[uid] = dict(blacklist)
+            if len(self.user_blacklists) > self.max_users:
+                self.user_blacklists.popitem(last=False)
+        return self.user_blacklists[uid].get(cmd, set())
+
+    async def get_candidates(self, cmd, uid):
         """
-        SELECT * FROM media.images
-        WHERE cmd = %s;
-        """,
-        (cmd,)
-    )
-    results = cursor.fetchall()
-    return [result["image_key"] for result in results]
+        Returns the keys uid is allowed to see,
+        or the whole collection if they've blacklisted all of it
+        """
+        keys = await self.get_cmd_keys(cmd)
+        blacklisted = await self.get_blacklisted(uid, cmd)
+        if not blacklisted:
+            return keys
+        allowed = tuple(key for key in keys if key not in blacklisted)
+        return allowed or keys
+
+    async def pick(self, cmd, uid):
+        keys = await self.get_cmd_keys(cmd)
+        if not keys:
+            return None
+        blacklisted = await self.get_blacklisted(uid, cmd)
+        if len(blacklisted) < len(keys) // 2:
+            # Most keys are allowed, so rejection sampling finishes quickly
+            # without building a filtered copy of the collection
+            while True:
+                chosen_key = random.choice(keys)
+                if chosen_key not in blacklisted:
+                    return chosen_key
+        return random.choice(await self.get_candidates(cmd, uid))
+
+    async def is_image(self, cmd, image_key):
+        await self.get_cmd_keys(cmd)
+        return image_key not in self.non_images[cmd]
+
+    async def get_rendition(self, cmd, image_key):
+        """Returns (rendition_key, rendition_content_type), or None"""
+        await self.get_cmd_keys(cmd)
+        return self.renditions[cmd].get(image_key)
+
+    async def claim_sid_stamp(self, cmd, image_key, uid):
+        """
+        Returns whether image_key is owned by uid and still needs a sid.
+        Only returns True once per image, since the caller will set it.
+        """
+        await self.get_cmd_keys(cmd)
+        cmd_unstamped = self.unstamped[cmd]
+        if cmd_unstamped.get(image_key) != as_ids(uid):
+            return False
+        del cmd_unstamped[image_key]
+        return True
+
+    def invalidate_cmd(self, cmd):
+        self.cmd_keys.pop(cmd, None)
+        self.unstamped.pop(cmd, None)
+        self.non_images.pop(cmd, None)
+        self.renditions.pop(cmd, None)
+
+    def invalidate_user(self, uid):
+        self.user_blacklists.pop(as_ids(uid), None)
+
+    def clear(self):
+        self.cmd_keys.clear()
+        self.unstamped.clear()
+        self.non_images.clear()
+        self.renditions.clear()
+        self.user_blacklists.clear()
 
 
 def add_blacklist_association(db_connection, cmd, image_key, uid):
@@ -647,7 +1020,6 @@ def add_blacklist_association(db_connection, cmd, image_key, uid):
         """,
         (cmd, image_key, uid)
     )
-    db_connection.commit()
 
 
 def remove_blacklist_association(db_connection, cmd, image_key, uid):
@@ -663,7 +1035,6 @@ def remove_blacklist_association(db_connection, cmd, image_key, uid):
         """,
         (cmd, image_key, uid)
     )
-    db_connection.commit()
 
 
 def get_user_blacklist(db_connection, uid):
@@ -680,27 +1051,102 @@ def get_user_blacklist(db_connection, uid):
     return [(result["cmd"], result["image_key"]) for result in results]
 
 
-def get_starting_keys_hashes(bucket):
-    keys, hashes = util.s3_keys_hashes(bucket, prefix="pictures/")
-    toplevel_dirs = set(key.split("/")[1] for key in keys)
-    collection_keys = {}
-    collection_hashes = {}
-    for collection in toplevel_dirs:
-        matching_indeces = [i for i, key in enumerate(keys)
-                            if key.split("/")[1] == collection]
-        collection_keys[collection] = [
-            keys[i].split("/")[-1] for i in matching_indeces]
-        collection_hashes[collection] = [
-            hashes[i] for i in matching_indeces]
+def split_picture_key(s3_key):
+    """Splits pictures/cmd/image_key into (cmd, image_key)"""
+    key_parts = s3_key.split("/")
+    return key_parts[1], key_parts[-1]
+
+
+def group_s3_objects(contents):
+    """
+    Groups S3 listing entries under pictures/ by collection in one pass.
+    Returns dicts mapping each collection to its image keys, hashes and sizes.
+    """
+    collection_keys = collections.defaultdict(list)
+    collection_hashes = collections.defaultdict(list)
+    collection_sizes = collections.defaultdict(list)
+    for content in contents:
+        collection, image_key = split_picture_key(content["Key"])
+        collection_keys[collection].append(image_key)
+        collection_hashes[collection].append(content["ETag"][1:-1])
+        collection_sizes[collection].append(content["Size"])
+    return (dict(collection_keys),
+            dict(collection_hashes),
+            dict(collection_sizes))
+
+
+def list_s3_pictures(bucket):
+    """
+    Lists every collection under pictures/ concurrently,
+    one worker per collection prefix.
+    """
+    collection_prefixes = list(
+        util.s3_common_prefixes(bucket, prefix="pictures/"))
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=S3_LIST_CONCURRENCY) as pool:
+        prefix_contents = pool.map(
+            lambda prefix: list(util.s3_objects(bucket, prefix=prefix)),
+            collection_prefixes)
+        contents = list(itertools.chain.from_iterable(prefix_contents))
+    logger.info(f"Listed {len(contents)} objects in "
+                f"{len(collection_prefixes)} collections from S3")
+    return contents
+
+
+def get_s3_manifest_from_db(db_connection):
+    """Returns the last S3 listing that was synced, as {s3_key: etag}"""
+    cursor = db_connection.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(
+        """
+        SELECT s3_key, etag, last_modified FROM media.s3_manifest;
+        """
+    )
+    results = cursor.fetchall()
+    return {result["s3_key"]: (result["etag"], result["last_modified"])
+            for result in results}
+
+
+def save_s3_manifest(db_connection, changed_contents, removed_keys):
+    cursor = db_connection.cursor()
+    psycopg2.extras.execute_values(
+        cursor,
+        """
+        INSERT INTO media.s3_manifest (s3_key, etag, last_modified)
+        VALUES %s
+        ON CONFLICT (s3_key) DO UPDATE
+        SET etag = EXCLUDED.etag, last_modified = EXCLUDED.last_modified;
+        """,
+        [(content["Key"], content["ETag"][1:-1], content["LastModified"])
+         for content in changed_contents]
+    )
+    cursor.execute(
+        """
+        DELETE FROM media.s3_manifest
+        WHERE s3_key = ANY(%s);
+        """,
+        (list(removed_keys),)
+    )
 
-    assert len(collection_keys) == len(collection_hashes), (
-        f"{len(collection_keys)=}, {len(collection_hashes)=}")
-    for cmd in collection_keys:
-        assert len(collection_keys[cmd]) == len(collection_hashes[cmd]), (
-            f"{cmd=}: {len(collection_keys[cmd])=}, "
-            f"{len(collection_hashes[cmd])=}")
 
-    return collection_keys, collection_hashes
+def diff_s3_manifest(manifest, contents, listing_started=None):
+    """
+    Compares an S3 listing to the last synced manifest.
+    Returns the listing entries that are new or changed,
+    and the keys that have disappeared since.
+    Keys modified after listing_started weren't necessarily listed,
+    so they're never counted as removed.
+    """
+    changed_contents = [
+        content for content in contents
+        if manifest.get(content["Key"])
+        != (content["ETag"][1:-1], content["LastModified"])
+    ]
+    listed_keys = {content["Key"] for content in contents}
+    removed_keys = [
+        key for key, (_, last_modified) in manifest.items()
+        if key not in listed_keys
+        and (listing_started is None or last_modified < listing_started)]
+    return changed_contents, removed_keys
 
 
 async def generate_image_embed_phrase_generic(ctx, call_bot_name):
@@ -761,99 +1207,607 @@ async def generate_image_embed(ctx, url, call_bot_name=False):
     return image_embed
 
 
-async def get_media_bytes_and_name(url, status_message=None, loading_emoji=""):
-    temp_dir = tempfile.TemporaryDirectory()
+async def generate_video_message(ctx, url, call_bot_name=False):
+    """
+    Message content for media that can't go in an embed, with the same
+    phrase an embed would have, so the URL still unfurls into a player
+    """
+    url = util.improve_url(url)
+    has_content = ctxhelpers.get_has_content(ctx)
+    invoked_command = ctxhelpers.get_invoked_command(ctx)
+    fstring = INTERACTION_CMDS.get(invoked_command)
+    phrase = await generate_image_embed_phrase(ctx, call_bot_name)
+    if has_content and not fstring:
+        phrase = f"**{ctx.author.display_name}**: {phrase}"
+    return f"{phrase}\n{url}" if phrase else url
+
+
+class FairQueue:
+    """
+    Queue that takes turns between users, and is first in first out
+    for each user, so one user queueing lots of jobs can't starve others.
+    """
+
+    def __init__(self):
+        self.user_jobs = collections.OrderedDict()
+        """Maps uid to a deque of jobs, in the order users get their turn"""
+
+    def __len__(self):
+        return sum(len(jobs) for jobs in self.user_jobs.values())
+
+    def push(self, uid, job):
+        self.user_jobs.setdefault(uid, collections.deque()).append(job)
+
+    def pop(self):
+        uid, jobs = next(iter(self.user_jobs.items()))
+        job = jobs.popleft()
+        if jobs:
+            self.user_jobs.move_to_end(uid)
+        else:
+            del self.user_jobs[uid]
+        return job
+
+    def in_order(self):
+        """Yields the queued jobs in the order pop would return them"""
+        longest_queue = max(map(len, self.user_jobs.values()), default=0)
+        for turn in range(longest_queue):
+            for jobs in self.user_jobs.values():
+                if turn < len(jobs):
+                    yield jobs[turn]
+
+
+class DownloadJob:
+    def __init__(self, args, future, on_queue_position):
+        self.args = args
+        self.future = future
+        self.on_queue_position = on_queue_position
+        self.queue_position = None
+
+
+class DownloadService:
+    """
+    Runs blocking downloads on a fixed number of worker threads,
+    shared by everyone, with waiting downloads taking turns between users.
+    """
+
+    def __init__(self, download_func, num_workers=DOWNLOAD_WORKERS):
+        self.download_func = download_func
+        self.num_workers = num_workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="download")
+        self.queue = FairQueue()
+        self.num_running = 0
+        self.position_updates = set()
+
+    async def run(self, uid, *args, on_queue_position=None):
+        """
+        Runs download_func(*args) when a worker is free and it's uid's turn.
+        While it waits, on_queue_position is called with the number of
+        downloads ahead of it, and with 0 once it starts.
+        """
+        job = DownloadJob(
+            args, asyncio.get_running_loop().create_future(),
+            on_queue_position)
+        self.queue.push(uid, job)
+        self.dispatch()
+        return await job.future
+
+    def dispatch(self):
+        while self.num_running < self.num_workers and self.queue:
+            job = self.queue.pop()
+            if job.future.done():
+                continue  # The caller stopped waiting
+            self.num_running += 1
+            if job.queue_position:
+                self.report_queue_position(job, 0)
+            executor_future = asyncio.get_running_loop().run_in_executor(
+                self.executor, self.download_func, *job.args)
+            executor_future.add_done_callback(
+                functools.partial(self.finish, job))
+        for queue_position, job in enumerate(self.queue.in_order(), start=1):
+            if job.queue_position != queue_position:
+                self.report_queue_position(job, queue_position)
+
+    def finish(self, job, executor_future):
+        self.num_running -= 1
+        if job.future.done():
+            pass
+        elif executor_future.cancelled():
+            job.future.cancel()
+        elif executor_future.exception() is not None:
+            job.future.set_exception(executor_future.exception())
+        else:
+            job.future.set_result(executor_future.result())
+        self.dispatch()
+
+    def report_queue_position(self, job, queue_position):
+        job.queue_position = queue_position
+        if job.on_queue_position is None:
+            return
+        update = asyncio.create_task(job.on_queue_position(queue_position))
+        self.position_updates.add(update)
+        update.add_done_callback(self.position_updates.discard)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+async def check_media_size(url, max_size=MAX_DOWNLOAD_SIZE):
+    """
+    Asks for the size of url without downloading it,
+    and raises MediaTooLarge if it's over max_size.
+    Pages that don't say how big they are get the benefit of the doubt.
+    """
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.head(
+                    url, allow_redirects=True,
+                    timeout=aiohttp.ClientTimeout(total=10)) as response:
+                content_length = response.content_length
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logger.info(f"Couldn't check the size of {url}: {e!r}")
+        return
+    if content_length is not None and content_length > max_size:
+        raise MediaTooLarge(f"{url} is {content_length} bytes")
+
+
+def download_media(url, output_dir):
+    """Downloads url into output_dir, and returns the downloaded file's path"""
     quality_format = "best[filesize<8M]/worst"
     ydl_options = {
         # "logger": logger,
         "quiet": True,
         "no_warnings": True,
         "format": quality_format,
-        "outtmpl": f"{temp_dir.name}/%(title)s.%(ext)s"
+        "max_filesize": MAX_DOWNLOAD_SIZE,
+        "outtmpl": f"{output_dir}/%(title)s.%(ext)s"
     }
     with youtube_dl.YoutubeDL(ydl_options) as ydl:
-        await status_message.edit(content=f"Downloading...{loading_emoji}")
-        download_start_time = discord.utils.utcnow()
-        with concurrent.futures.ThreadPoolExecutor() as pool:
-            await asyncio.get_running_loop().run_in_executor(
-                pool, ydl.extract_info, url)  # This guy takes a while
-        download_time = discord.utils.utcnow() - download_start_time
-        logger.info(f"{url} took {download_time} to download")
-        files_in_dir = os.listdir(temp_dir.name)
-        if len(files_in_dir) == 0:
-            raise youtube_dl.utils.DownloadError("No file found")
-        elif len(files_in_dir) > 1:
-            logger.warning(
-                f"youtube_dl got more than one file: {files_in_dir}")
-            raise youtube_dl.utils.DownloadError(
-                "Multiple files received")
-        filename = files_in_dir[0]
-        filepath = f"{temp_dir.name}/{filename}"
-        # Fix bad extension
-        temp_filepath = f"{filepath}2"
-        os.rename(filepath, temp_filepath)
-        if filepath.endswith(".mkv"):
-            filepath += ".webm"
-        await status_message.edit(content=f"Processing...{loading_emoji}")
-        processing_start_time = discord.utils.utcnow()
+        ydl.extract_info(url)  # This guy takes a while
+    files_in_dir = os.listdir(output_dir)
+    if len(files_in_dir) == 0:
+        raise youtube_dl.utils.DownloadError("No file found")
+    elif len(files_in_dir) > 1:
+        logger.warning(
+            f"youtube_dl got more than one file: {files_in_dir}")
+        raise youtube_dl.utils.DownloadError(
+            "Multiple files received")
+    return f"{output_dir}/{files_in_dir[0]}"
+
+
+async def get_media_bytes_and_name(
+        url, downloads, uid, status_message=None, loading_emoji=""):
+    temp_dir = tempfile.TemporaryDirectory()
+
+    async def show_queue_position(queue_position):
+        content = (f"Downloading...{loading_emoji}" if not queue_position
+                   else f"Waiting for {queue_position} other download(s)..."
+                   f"{loading_emoji}")
+        try:
+            await status_message.edit(content=content)
+        except discord.errors.NotFound:
+            pass
+
+    await check_media_size(url)
+    await status_message.edit(content=f"Downloading...{loading_emoji}")
+    download_start_time = discord.utils.utcnow()
+    filepath = await downloads.run(
+        uid, url, temp_dir.name, on_queue_position=show_queue_position)
+    download_time = discord.utils.utcnow() - download_start_time
+    logger.info(f"{url} took {download_time} to download")
+    # Fix bad extension
+    temp_filepath = f"{filepath}2"
+    os.rename(filepath, temp_filepath)
+    if filepath.endswith(".mkv"):
+        filepath += ".webm"
+    await status_message.edit(content=f"Processing...{loading_emoji}")
+    processing_start_time = discord.utils.utcnow()
+    try:
+        filepath = await convert_video(temp_filepath, filepath)
+    except NotVideo:
+        os.rename(temp_filepath, filepath)
+    processing_time = discord.utils.utcnow() - processing_start_time
+    logger.info(f"{url} took {processing_time} to process")
+    with open(filepath, "rb") as downloaded_file:
+        data = downloaded_file.read()
+    return data, filepath, temp_dir
+
+
+class TranscodeScheduler:
+    """
+    Runs ffmpeg and ffprobe as asyncio subprocesses, with at most
+    max_concurrency of them at once; the rest wait their turn.
+    """
+
+    def __init__(self, max_concurrency=TRANSCODE_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.semaphore = None  # Made on first use, inside the bot's loop
+        self.num_waiting = 0
+        self.num_running = 0
+        self.num_finished = 0
+        self.num_failed = 0
+        self.total_wait_time = 0.0
+        self.total_run_time = 0.0
+        self.size_ratios = collections.deque(maxlen=100)
+        """Actual over predicted output size of recent encodes"""
+
+    def record_encode_size(self, predicted_size, actual_size):
+        logger.info(f"Encode predicted {predicted_size:.0f} bytes, "
+                    f"got {actual_size} bytes")
+        if predicted_size:
+            self.size_ratios.append(actual_size / predicted_size)
+
+    async def run(self, cmds, timeout=TRANSCODE_TIMEOUT):
+        """
+        Runs cmds and returns its (returncode, stdout, stderr).
+        The process is killed if it takes longer than timeout seconds,
+        raising asyncio.TimeoutError, or if the caller is cancelled.
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        queued_time = time.monotonic()
+        self.num_waiting += 1
         try:
-            await convert_video(temp_filepath, filepath)
-        except NotVideo:
-            os.rename(temp_filepath, filepath)
-        processing_time = discord.utils.utcnow() - processing_start_time
-        logger.info(f"{url} took {processing_time} to process")
-        with open(filepath, "rb") as downloaded_file:
-            data = downloaded_file.read()
-        return data, filepath, temp_dir
+            await self.semaphore.acquire()
+        finally:
+            self.num_waiting -= 1
+        start_time = time.monotonic()
+        self.total_wait_time += start_time - queued_time
+        self.num_running += 1
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmds,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+            try:
+                output, err = await asyncio.wait_for(
+                    process.communicate(), timeout)
+            except BaseException:
+                if process.returncode is None:
+                    logger.warning(f"Killing {cmds[0]} on {cmds[-1]}")
+                    process.kill()
+                    await process.wait()
+                raise
+        except BaseException:
+            self.num_failed += 1
+            raise
+        else:
+            self.num_finished += 1
+        finally:
+            self.num_running -= 1
+            self.total_run_time += time.monotonic() - start_time
+            self.semaphore.release()
+        return process.returncode, output, err
+
+    def status_text(self):
+        num_done = self.num_finished + self.num_failed
+        average_wait_time = self.total_wait_time / max(num_done, 1)
+        average_run_time = self.total_run_time / max(num_done, 1)
+        average_size_ratio = (
+            sum(self.size_ratios) / len(self.size_ratios)
+            if self.size_ratios else 0)
+        return (f"{self.num_running}/{self.max_concurrency} transcodes "
+                f"running, {self.num_waiting} waiting, "
+                f"{self.num_finished} finished, {self.num_failed} failed; "
+                f"average wait {average_wait_time:.1f}s, "
+                f"average run {average_run_time:.1f}s, "
+                f"encodes average {average_size_ratio:.2f}x predicted size")
+
+
+TRANSCODER = TranscodeScheduler()
+
+
+def parse_media_info(probe_output):
+    """Pulls what convert_video needs out of ffprobe's JSON output"""
+    probe = json.loads(probe_output or "{}")
+    format_info = probe.get("format", {})
+    # Cover art on audio files shows up as a video stream
+    streams = [stream for stream in probe.get("streams", [])
+               if not stream.get("disposition", {}).get("attached_pic")]
+
+    def first_stream(codec_type):
+        return next((stream for stream in streams
+                     if stream.get("codec_type") == codec_type), {})
+
+    video_stream = first_stream("video")
+    try:
+        frames, seconds = video_stream.get("r_frame_rate", "").split("/")
+        fps = float(frames) / float(seconds)
+    except (ValueError, ZeroDivisionError):
+        fps = None
 
+    try:
+        duration = float(format_info.get("duration"))
+    except (TypeError, ValueError):
+        duration = None
+    return {
+        "format_name": format_info.get("format_name"),
+        "duration": duration,
+        "size": int(format_info.get("size") or 0),
+        "video_codec": video_stream.get("codec_name"),
+        "audio_codec": first_stream("audio").get("codec_name"),
+        "width": video_stream.get("width"),
+        "height": video_stream.get("height"),
+        "fps": fps,
+    }
 
-async def get_video_length(video_input):
+
+async def probe_media(media_input):
     cmds = ["ffprobe",
             "-v", "error",
             "-show_entries",
-            "format=duration",
-            "-of",
-            "default=noprint_wrappers=1:nokey=1",
-            video_input
+            "format=format_name,duration,size"
+            ":stream=codec_type,codec_name,width,height,r_frame_rate"
+            ":stream_disposition=attached_pic",
+            "-of", "json",
+            media_input
             ]
-    p = subprocess.Popen(cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    while p.poll() is None:
-        await asyncio.sleep(0)
-    output, err = p.communicate()
-    try:
-        video_length = float(output)
-    except ValueError:
+    _, output, err = await TRANSCODER.run(cmds)
+    return parse_media_info(output)
+
+
+def plan_conversion(media_info, filename):
+    """
+    Decides how convert_video should handle a file, returning one of
+    ("passthrough", None) if it can be used as is,
+    ("remux", extension) if it only needs a container Discord plays,
+    or ("encode", None) if it has to be re-encoded.
+    Raises NotVideo for things without a duration, like images.
+    """
+    video_codec = media_info["video_codec"]
+    audio_codec = media_info["audio_codec"]
+    if not media_info["duration"] or (video_codec is None
+                                      and audio_codec is None):
         raise NotVideo()
-    return video_length
+    if video_codec in IMAGE_CODECS and audio_codec is None:
+        raise NotVideo()  # Animated images get a rendition instead
+    if media_info["size"] * 8 > MAX_VIDEO_SIZE:
+        return "encode", None
+    fitting_extensions = [
+        extension
+        for extension, (video_codecs, audio_codecs) in PLAYABLE_CODECS.items()
+        if ((video_codec is None or video_codec in video_codecs)
+            and (audio_codec is None or audio_codec in audio_codecs))]
+    if not fitting_extensions:
+        return "encode", None
+    # The name can lie, eg mkvs are renamed to .mkv.webm before converting
+    demuxer, codecs_extension = PLAYABLE_EXTENSIONS.get(
+        os.path.splitext(filename)[1].lower(), (None, None))
+    format_names = (media_info["format_name"] or "").split(",")
+    if demuxer in format_names and codecs_extension in fitting_extensions:
+        return "passthrough", None
+    return "remux", fitting_extensions[0]
 
 
 def suggest_audio_video_bitrate(video_length):
     if not video_length:
         raise NotVideo()
     audio_bitrate = 64e3  # bits
-    max_size = 32e6  # bits. Technically 64e6 but there's some error.
-    video_bitrate = (max_size / video_length) - audio_bitrate
+    video_bitrate = (MAX_VIDEO_SIZE / video_length) - audio_bitrate
     video_bitrate = max(int(video_bitrate), 1e3)
     return audio_bitrate, video_bitrate
 
 
-async def convert_video(video_input, video_output, log=False):
-    video_length = await get_video_length(video_input)
-    audio_bitrate, video_bitrate = suggest_audio_video_bitrate(video_length)
+def choose_encoding(media_info):
+    """
+    Picks the resolution, frame rate and bitrates to encode at so the
+    output fits MAX_VIDEO_SIZE, taking the best ladder rung that still
+    gets MIN_BITS_PER_PIXEL. Never upscales.
+    Raises QualityTooLow if even the lowest rung can't look acceptable.
+    """
+    duration = media_info["duration"]
+    audio_bitrate, video_bitrate = suggest_audio_video_bitrate(duration)
+    if media_info["audio_codec"] is None:
+        audio_bitrate = 0
+        video_bitrate = MAX_VIDEO_SIZE / duration
+    encoding = {"audio_bitrate": audio_bitrate}
+    if media_info["video_codec"] is None:
+        if audio_bitrate * duration > MAX_VIDEO_SIZE:
+            raise QualityTooLow(f"{duration}s of audio won't fit")
+        encoding["predicted_size"] = audio_bitrate * duration / 8
+        return encoding
+    source_height = media_info["height"]
+    aspect_ratio = (media_info["width"] / source_height
+                    if media_info["width"] and source_height else 16 / 9)
+    for rung_height, rung_fps in ENCODING_LADDER:
+        height = min(rung_height, source_height or rung_height)
+        fps = min(rung_fps, media_info["fps"] or rung_fps)
+        min_video_bitrate = (
+            height * height * aspect_ratio * fps * MIN_BITS_PER_PIXEL)
+        if video_bitrate >= min_video_bitrate:
+            break
+    else:
+        raise QualityTooLow(
+            f"{duration}s of video only gets {video_bitrate:.0f}bps")
+    encoding.update({"height": height,
+                     "fps": fps,
+                     "video_bitrate": int(video_bitrate),
+                     "predicted_size": (
+                         (video_bitrate + audio_bitrate) * duration / 8)})
+    return encoding
+
+
+async def remux_video(video_input, video_output):
     cmds = ["ffmpeg",
             "-y",
             "-i", video_input,
-            "-b:v", str(video_bitrate),
-            "-b:a", str(audio_bitrate),
+            "-c", "copy",
+            "-movflags", "+faststart",
             video_output
             ]
-    p = subprocess.Popen(cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    while p.poll() is None:
-        await asyncio.sleep(0)
-    output, err = p.communicate()
+    returncode, output, err = await TRANSCODER.run(cmds)
+    return returncode == 0 and os.path.isfile(video_output)
+
+
+async def convert_video(video_input, video_output, log=False):
+    """
+    Makes video_input something Discord can play without going over
+    the size limit, re-encoding only if it has to.
+    Returns the converted file's path, which has a different extension
+    from video_output if it was remuxed.
+    """
+    media_info = await probe_media(video_input)
+    action, extension = plan_conversion(media_info, video_output)
+    logger.info(f"Converting {video_input}: {action} {media_info}")
+    if action == "passthrough":
+        os.rename(video_input, video_output)
+        return video_output
+    if action == "remux":
+        remux_output = f"{os.path.splitext(video_output)[0]}{extension}"
+        if await remux_video(video_input, remux_output):
+            return remux_output
+        logger.warning(f"Couldn't remux {video_input}, so encoding it")
+    encoding = choose_encoding(media_info)
+    logger.info(f"Encoding {video_input} with {encoding}")
+    cmds = ["ffmpeg", "-y", "-i", video_input]
+    if "video_bitrate" in encoding:
+        video_filter = f"scale=-2:{encoding['height']},fps={encoding['fps']}"
+        cmds += ["-vf", video_filter,
+                 "-b:v", str(encoding["video_bitrate"])]
+    if encoding["audio_bitrate"]:
+        cmds += ["-b:a", str(encoding["audio_bitrate"])]
+    cmds.append(video_output)
+    _, output, err = await TRANSCODER.run(cmds)
     if log:
         logger.info(f"ffmpeg output: {output}")
         logger.info(f"ffmpeg err: {err}")
     if not os.path.isfile(video_output):
         raise FileNotFoundError(
             f"ffmpeg failed to convert {video_input} to {video_output}")
+    TRANSCODER.record_encode_size(
+        encoding["predicted_size"], os.path.getsize(video_output))
+    return video_output
+
+
+async def count_frames(media_input):
+    cmds = ["ffprobe",
+            "-v", "error",
+            "-count_packets",
+            "-select_streams", "v:0",
+            "-show_entries", "stream=nb_read_packets",
+            "-of", "default=noprint_wrappers=1:nokey=1",
+            media_input
+            ]
+    _, output, err = await TRANSCODER.run(cmds)
+    try:
+        return int(output)
+    except ValueError:
+        return 0
+
+
+async def make_gif_rendition(filepath):
+    """
+    Encodes an animated GIF as an MP4, which is usually a fraction of the
+    size. Returns the MP4's path, or None if filepath isn't an animated GIF
+    or the MP4 wouldn't be any smaller.
+    """
+    if util.guess_content_type(filepath) != "image/gif":
+        return None
+    if await count_frames(filepath) <= 1:
+        return None
+    rendition_path = f"{os.path.splitext(filepath)[0]}.mp4"
+    cmds = ["ffmpeg",
+            "-y",
+            "-i", filepath,
+            "-movflags", "+faststart",
+            "-pix_fmt", "yuv420p",
+            # yuv420p needs even dimensions
+            "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+            "-c:v", "libx264",
+            "-crf", "23",
+            "-an",
+            rendition_path
+            ]
+    try:
+        returncode, output, err = await TRANSCODER.run(cmds)
+    except asyncio.TimeoutError:
+        returncode, err = None, "timed out"
+    if returncode != 0 or not os.path.isfile(rendition_path):
+        logger.warning(f"Couldn't make a rendition of {filepath}: {err}")
+        return None
+    original_size = os.path.getsize(filepath)
+    rendition_size = os.path.getsize(rendition_path)
+    logger.info(f"{filepath} is {original_size} bytes, "
+                f"its rendition is {rendition_size} bytes")
+    if rendition_size >= original_size:
+        return None
+    return rendition_path
+
+
+def optimize_still_image(filepath):
+    """
+    Writes a smaller copy of a still image next to it, capped to
+    MAX_VARIANT_DIMENSION, recompressed, and without EXIF metadata.
+    Returns the copy's path, or None if it wouldn't be meaningfully smaller.
+    Runs in a worker process, since it's all CPU.
+    """
+    try:
+        with Image.open(filepath) as image:
+            output_format = VARIANT_FORMATS.get(image.format)
+            if output_format is None or getattr(image, "is_animated", False):
+                return None
+            # Lets JPEGs decode straight to a smaller size
+            image.draft("RGB", (MAX_VARIANT_DIMENSION, MAX_VARIANT_DIMENSION))
+            icc_profile = image.info.get("icc_profile")
+            # Orientation lives in the EXIF data that's being dropped
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((MAX_VARIANT_DIMENSION, MAX_VARIANT_DIMENSION))
+            save_options = {"optimize": True, "icc_profile": icc_profile}
+            if output_format == "JPEG":
+                save_options.update(quality=85, progressive=True)
+            elif output_format == "WEBP":
+                save_options.update(quality=85, method=4)
+            extension = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp"}[
+                output_format]
+            variant_path = (
+                f"{os.path.splitext(filepath)[0]}.variant{extension}")
+            image.save(variant_path, output_format, **save_options)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning(f"Couldn't optimize {filepath}: {e!r}")
+        return None
+    original_size = os.path.getsize(filepath)
+    variant_size = os.path.getsize(variant_path)
+    if variant_size > original_size * 0.9:
+        os.remove(variant_path)
+        return None
+    return variant_path
+
+
+async def make_still_variant(image_pool, filepath):
+    """Runs optimize_still_image in image_pool, a process pool"""
+    variant_path = await asyncio.get_running_loop().run_in_executor(
+        image_pool, optimize_still_image, filepath)
+    if variant_path:
+        logger.info(f"{filepath} is {os.path.getsize(filepath)} bytes, "
+                    f"its variant is {os.path.getsize(variant_path)} bytes")
+    return variant_path
+
+
+def dhash_image(filepath):
+    """
+    Difference hash of an image's first frame: shrinks it to a
+    (PHASH_SIZE + 1) x PHASH_SIZE grayscale grid and records whether each
+    pixel is brighter than its right neighbour. Survives resizing and
+    recompression. Returns None for anything Pillow can't open, like videos.
+    """
+    try:
+        with Image.open(filepath) as image:
+            image.draft("L", (PHASH_SIZE * 8, PHASH_SIZE * 8))
+            grid = ImageOps.exif_transpose(image).convert("L").resize(
+                (PHASH_SIZE + 1, PHASH_SIZE), Image.LANCZOS)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    pixels = grid.tobytes()
+    phash = 0
+    for row in range(PHASH_SIZE):
+        for column in range(PHASH_SIZE):
+            left = pixels[row * (PHASH_SIZE + 1) + column]
+            phash = (phash << 1) | (left > pixels[
+                row * (PHASH_SIZE + 1) + column + 1])
+    return phash
+
+
+async def hash_image(image_pool, filepath):
+    """Runs dhash_image in image_pool, a process pool"""
+    return await asyncio.get_running_loop().run_in_executor(
+        image_pool, dhash_image, filepath)
@@ -7,9 +7,8 @@ import tempfile
 import sys
 from discord.ext import commands
 from pathlib import Path
-import time
-import psycopg2
 from . import util
+from .database import Database
 import boto3
 
 LOGGING_FORMAT = ("%(asctime)-15s %(levelname)s in %(funcName)s "
@@ -21,8 +20,6 @@ logger = logging.getLogger()
 
 logger.info("\n\nEntering makubot.py\n\n")
 
-DATABASE_CONNECT_MAX_RETRIES = 10
-
 S3 = boto3.client("s3")
 
 
@@ -83,6 +80,12 @@ class MakuBot(commands.Bot):
         self.db_port = db_port
         self.db_user = db_user
         self.db_name = db_name
+        self.db = None
+        self.command_fallbacks = []
+        """
+        Functions from an invoked name to a Command (or None),
+        tried in order when the name isn't a registered command
+        """
 
     async def setup_hook(self):
         logger.info("Bot entering setup")
@@ -93,25 +96,13 @@ class MakuBot(commands.Bot):
             f"on port {self.db_port} as user {self.db_user} "
             f"with db_name {self.db_name}"
         )
-        for _ in range(DATABASE_CONNECT_MAX_RETRIES):
-            try:
-                self.db_connection = psycopg2.connect(
-                    host=self.db_host,
-                    password=self.db_pass,
-                    port=self.db_port,
-                    user=self.db_user,
-                )
-            except psycopg2.OperationalError:
-                logger.info(
-                    "Couldn't connect to mbdb, retrying in a few seconds")
-                time.sleep(5)
-                continue
-            else:
-                break
-        else:
-            raise psycopg2.OperationalError("Couldn't connect after retries")
-
-        num_db_tables = util.get_num_tables(self.db_connection)
+        self.db = await Database.connect(
+            host=self.db_host,
+            password=self.db_pass,
+            port=self.db_port,
+            user=self.db_user,
+        )
+        num_db_tables = await self.db.run(util.get_num_tables)
         logger.info(f"Started with {num_db_tables} tables")
         if not num_db_tables:
             logger.info("Restoring DB from S3")
@@ -120,6 +111,21 @@ class MakuBot(commands.Bot):
         for extension in self.shared["default_extensions"]:
             await self.load_extension(f"src.{extension}")
 
+    async def get_context(self, origin, *, cls=commands.Context):
+        ctx = await super().get_context(origin, cls=cls)
+        if ctx.command is None and ctx.invoked_with:
+            for fallback in self.command_fallbacks:
+                command = fallback(ctx.invoked_with)
+                if command is not None:
+                    ctx.command = command
+                    break
+        return ctx
+
+    async def close(self):
+        await super().close()
+        if self.db:
+            self.db.close()
+
     async def on_ready(self):
         """
         Called when MakuBot has logged in and is ready to accept commands
@@ -8,37 +8,105 @@ import asyncio
 logger = logging.getLogger()
 
 
+def create_log_channel_tables(db_connection):
+    cursor = db_connection.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS log_channels (
+        guild_id CHARACTER(18) PRIMARY KEY,
+        log_channel_id CHARACTER(18));
+        """)
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS extra_log_channel (
+        guild_id CHARACTER(18) PRIMARY KEY,
+        log_channel_id CHARACTER(18));
+        """)
+
+
+def remove_log_channel_from_db(db_connection, guild_id):
+    cursor = db_connection.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(
+        """
+        DELETE FROM log_channels WHERE guild_id = %s
+        """,
+        (guild_id,)
+    )
+
+
+def add_log_channel_to_db(db_connection, guild_id, log_channel_id):
+    cursor = db_connection.cursor()
+    cursor.execute(
+        """
+        INSERT INTO log_channels (
+        guild_id,
+        log_channel_id)
+        VALUES (%s, %s)
+        """,
+        (guild_id, log_channel_id)
+    )
+
+
+def set_extra_log_channel_on_db(db_connection, guild_id, log_channel_id):
+    cursor = db_connection.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(
+        """
+        DELETE FROM extra_log_channel *;
+        """
+    )
+    cursor.execute(
+        """
+        INSERT INTO extra_log_channel (
+        guild_id,
+        log_channel_id)
+        VALUES (%s, %s)
+        """,
+        (guild_id, log_channel_id)
+    )
+
+
+def get_extra_log_channel_id_from_db(db_connection):
+    cursor = db_connection.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(
+        """
+        SELECT * FROM extra_log_channel;
+        """
+    )
+    results = cursor.fetchall()
+    if not results:
+        return None
+    return results[0]["log_channel_id"]
+
+
+def get_log_channel_id_from_db(db_connection, guild_id, channel_id):
+    cursor = db_connection.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(
+        """
+        SELECT * FROM log_channels
+        WHERE guild_id = %s
+        AND log_channel_id != %s
+        LIMIT 1""",
+        (guild_id, channel_id)
+    )
+    log_channel_results = cursor.fetchall()
+    if not log_channel_results:
+        return None
+    return log_channel_results[0]["log_channel_id"]
+
+
 class ServerLogging(discord.ext.commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.last_deleted_message = {}
         """Maps channel ID to (last deleted message content, sender)"""
-        cursor = self.bot.db_connection.cursor()
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS log_channels (
-            guild_id CHARACTER(18) PRIMARY KEY,
-            log_channel_id CHARACTER(18));
-            """)
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS extra_log_channel (
-            guild_id CHARACTER(18) PRIMARY KEY,
-            log_channel_id CHARACTER(18));
-            """)
-        self.bot.db_connection.commit()
+
+    async def cog_load(self):
+        await self.bot.db.run(create_log_channel_tables)
 
     @commands.command(hidden=True, aliases=["removelogchannel"])
     @commands.is_owner()
     async def remove_log_channel(self, ctx):
-        cursor = self.bot.db_connection.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(
-            """
-            DELETE FROM log_channels WHERE guild_id = %s
-            """,
-            (ctx.guild.id,)
-        )
-        self.bot.db_connection.commit()
+        await self.bot.db.run(remove_log_channel_from_db, ctx.guild.id)
         await ctx.send("Coolio")
 
     @commands.command(hidden=True, aliases=["addlogchannel"])
@@ -47,17 +115,7 @@ class ServerLogging(discord.ext.commands.Cog):
         guild_id, log_channel_id = str(ctx.guild.id), str(log_channel.id)
         # TODO see what happens when you add a second log channel
         # (wouldn't be unique primary key)
-        cursor = self.bot.db_connection.cursor()
-        cursor.execute(
-            """
-            INSERT INTO log_channels (
-            guild_id,
-            log_channel_id)
-            VALUES (%s, %s)
-            """,
-            (guild_id, log_channel_id)
-        )
-        self.bot.db_connection.commit()
+        await self.bot.db.run(add_log_channel_to_db, guild_id, log_channel_id)
         await ctx.send(r"You gotcha \o/")
 
     @commands.command(aliases=["what was that",
@@ -74,60 +132,30 @@ class ServerLogging(discord.ext.commands.Cog):
     @commands.is_owner()
     async def set_extra_log_channel(self, ctx,
                                     log_channel: discord.TextChannel):
-        cursor = self.bot.db_connection.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(
-            """
-            DELETE FROM extra_log_channel *;
-            """
-        )
-        cursor.execute(
-            """
-            INSERT INTO extra_log_channel (
-            guild_id,
-            log_channel_id)
-            VALUES (%s, %s)
-            """,
-            (str(log_channel.guild.id), str(log_channel.id))
-        )
-        self.bot.db_connection.commit()
+        await self.bot.db.run(
+            set_extra_log_channel_on_db,
+            str(log_channel.guild.id), str(log_channel.id))
         await ctx.send("Done!")
 
-    def get_extra_log_channel(self):
-        cursor = self.bot.db_connection.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(
-            """
-            SELECT * FROM extra_log_channel;
-            """
-        )
-        results = cursor.fetchall()
-        if not results:
+    async def get_extra_log_channel(self):
+        channel_id = await self.bot.db.run(get_extra_log_channel_id_from_db)
+        if channel_id is None:
             return None
-        result = results[0]
-        channel_id = result["log_channel_id"]
         extra_log_channel = self.bot.get_channel(int(channel_id))
         return extra_log_channel
 
     async def get_log_channels(self, guild, channel):
-        extra_log_channel = self.get_extra_log_channel()
+        extra_log_channel = await self.get_extra_log_channel()
         if guild is None:
             return [extra_log_channel] if extra_log_channel else []
-        cursor = self.bot.db_connection.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(
-            """
-            SELECT * FROM log_channels
-            WHERE guild_id = %s
-            AND log_channel_id != %s
-            LIMIT 1""",
-            (str(guild.id), str(getattr(channel, "id", None)))
-        )
-        log_channel_results = cursor.fetchall()
-        if not log_channel_results:
+        log_to_channel_id = await self.bot.db.run(
+            get_log_channel_id_from_db,
+            str(guild.id), str(getattr(channel, "id", None)))
+        if log_to_channel_id is None:
             if extra_log_channel:
                 return (extra_log_channel,)
             return ()
-        log_to_channel_dict = log_channel_results[0]
         log_to_channels = []
-        log_to_channel_id = log_to_channel_dict["log_channel_id"]
         if log_to_channel_id != str(channel.id):
             log_to_channel_obj = self.bot.get_channel(
                 int(log_to_channel_id))
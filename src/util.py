@@ -1,7 +1,7 @@
 import traceback
 import logging
 import urllib
-import aiohttp
+import mimetypes
 import subprocess
 from psycopg2.extras import RealDictCursor
 import boto3
@@ -54,19 +54,36 @@ def url_from_s3_key(s3_bucket,
     return url
 
 
-def s3_keys_hashes(bucket, prefix="/", delimiter="/", start_after=""):
-    s3_paginator = boto3.client("s3").get_paginator("list_objects_v2")
+def s3_objects(bucket, prefix="/", delimiter="/", start_after=""):
+    """Yields the S3 listing entries (Key, ETag, Size...) under prefix"""
+    # Clients are thread-safe, so the shared one can list from worker threads
+    s3_paginator = S3.get_paginator("list_objects_v2")
     prefix = prefix[1:] if prefix.startswith(delimiter) else prefix
     start_after = ((start_after or prefix) if prefix.endswith(delimiter)
                    else start_after)
-    keys = []
-    hashes = []
     for page in s3_paginator.paginate(Bucket=bucket,
                                       Prefix=prefix,
                                       StartAfter=start_after):
-        for content in page.get("Contents", ()):
-            keys.append(content["Key"])
-            hashes.append(content["ETag"][1:-1])
+        yield from page.get("Contents", ())
+
+
+def s3_common_prefixes(bucket, prefix="/", delimiter="/"):
+    """Yields the "subdirectories" directly under prefix, like pictures/cmd/"""
+    s3_paginator = S3.get_paginator("list_objects_v2")
+    prefix = prefix[1:] if prefix.startswith(delimiter) else prefix
+    for page in s3_paginator.paginate(Bucket=bucket,
+                                      Prefix=prefix,
+                                      Delimiter=delimiter):
+        for common_prefix in page.get("CommonPrefixes", ()):
+            yield common_prefix["Prefix"]
+
+
+def s3_keys_hashes(bucket, prefix="/", delimiter="/", start_after=""):
+    keys = []
+    hashes = []
+    for content in s3_objects(bucket, prefix, delimiter, start_after):
+        keys.append(content["Key"])
+        hashes.append(content["ETag"][1:-1])
     return keys, hashes
 
 
@@ -158,14 +175,14 @@ async def clean(ctx, s):
     return await converter.convert(ctx, s)
 
 
-async def url_media_type(url):
-    async with aiohttp.request("HEAD", url) as response:
-        return response.content_type
+def guess_content_type(filename):
+    content_type, _ = mimetypes.guess_type(filename)
+    return content_type or "binary/octet-stream"
 
 
-async def url_is_image(url):
-    media_type = await url_media_type(url)
-    return media_type.split("/")[0].lower() == "image"
+def content_type_is_image(content_type):
+    return bool(content_type) and (
+        content_type.split("/")[0].lower() == "image")
 
 
 def db_size(db_connection):
@@ -1,15 +1,51 @@
+import asyncio
+import functools
+import json
+import itertools
+import types
+import sys
+import os
+import psycopg2
+from PIL import Image
+from discord.ext import commands
 from src.picturecommands_utils import (
     as_text,
     as_ids,
     suggest_audio_video_bitrate,
+    CommandAliasIndex,
+    CandidateImageCache,
+    RandomImageSampler,
+    CommandSizeCounter,
+    group_s3_objects,
+    diff_s3_manifest,
+    FairQueue,
+    DownloadService,
+    TranscodeScheduler,
+    parse_media_info,
+    plan_conversion,
+    NotVideo,
+    choose_encoding,
+    QualityTooLow,
+    optimize_still_image,
+    MAX_VARIANT_DIMENSION,
+    BKTree,
+    hamming_distance,
+    dhash_image,
+    phash_to_db,
+    phash_from_db,
 )
 from src.util import (
     improve_url,
     url_from_s3_key,
     get_nonconflicting_filename,
     split_text_to_chunks,
+    guess_content_type,
+    content_type_is_image,
 )
 from src import ctxhelpers
+from src.base import get_prefix
+from src.listeners import PresenceManager
+from src.database import Database
 
 
 id_text_pairs = [
@@ -127,3 +163,441 @@ def test_split_text_to_chunks_with_max_separator():
         "123456 1234 123",
         "1 12 12345678"
     )
+
+
+def test_command_alias_index():
+    index = CommandAliasIndex(
+        cmds={"lupo", "nao"}, aliases={"wolf": "lupo", "tomori": "nao"})
+    assert index.resolve("lupo") == "lupo"
+    assert index.resolve("Wolf") == "lupo"
+    assert index.resolve("nope") is None
+    index.add_alias("wolfie", "lupo")
+    assert index.remove_cmd("lupo") == {"lupo", "wolf", "wolfie"}
+    assert "wolf" not in index
+    assert index.invocations() == {"nao", "tomori"}
+
+
+async def check_candidate_image_cache():
+    loads = []
+
+    async def load_cmd_images(cmd):
+        loads.append(cmd)
+        return [
+            {"image_key": "a.png", "uid": None, "sid": None,
+             "content_type": "image/png", "rendition_key": None,
+             "rendition_content_type": None},
+            {"image_key": "b.gif", "uid": None, "sid": None,
+             "content_type": "image/gif", "rendition_key": "b.gif.mp4",
+             "rendition_content_type": "video/mp4"},
+            {"image_key": "c.png", "uid": "203285581004931072", "sid": None,
+             "content_type": "video/mp4", "rendition_key": None,
+             "rendition_content_type": None},
+            {"image_key": "d.jpg", "uid": None, "sid": None,
+             "content_type": None, "rendition_key": None,
+             "rendition_content_type": None},
+        ]
+
+    async def load_user_blacklist(uid):
+        return ([("lupo", "a.png"), ("lupo", "b.gif"), ("lupo", "d.jpg")]
+                if uid == 1 else [])
+
+    cache = CandidateImageCache(load_cmd_images, load_user_blacklist)
+    assert await cache.get_candidates("lupo", 1) == ("c.png",)
+    assert await cache.pick("lupo", 1) == "c.png"
+    assert len(await cache.get_candidates("lupo", 2)) == 4
+    assert loads == ["lupo"]
+    assert await cache.is_image("lupo", "a.png")
+    assert await cache.get_rendition("lupo", "a.png") is None
+    assert await cache.get_rendition("lupo", "b.gif") == (
+        "b.gif.mp4", "video/mp4")
+    assert not await cache.is_image("lupo", "c.png")
+    assert await cache.is_image("lupo", "d.jpg")
+    assert not await cache.claim_sid_stamp("lupo", "c.png", 1)
+    assert await cache.claim_sid_stamp("lupo", "c.png", 203285581004931072)
+    assert not await cache.claim_sid_stamp(
+        "lupo", "c.png", 203285581004931072)
+    cache.invalidate_cmd("lupo")
+    await cache.get_cmd_keys("lupo")
+    assert loads == ["lupo", "lupo"]
+
+
+def test_candidate_image_cache():
+    asyncio.run(check_candidate_image_cache())
+
+
+async def check_candidate_image_cache_all_blacklisted():
+    async def load_cmd_images(cmd):
+        return [{"image_key": "a.png", "uid": None, "sid": None,
+                 "content_type": "image/png", "rendition_key": None,
+                 "rendition_content_type": None}]
+
+    async def load_user_blacklist(uid):
+        return [("lupo", "a.png")]
+
+    cache = CandidateImageCache(load_cmd_images, load_user_blacklist)
+    assert await cache.get_candidates("lupo", 1) == ("a.png",)
+
+
+def test_candidate_image_cache_all_blacklisted():
+    asyncio.run(check_candidate_image_cache_all_blacklisted())
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.commits = 0
+        self.rollbacks = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeConnectionPool:
+    maxconn = 1
+
+    def __init__(self):
+        self.db_connection = FakeConnection()
+        self.checked_out = False
+
+    def getconn(self):
+        assert not self.checked_out
+        self.checked_out = True
+        return self.db_connection
+
+    def putconn(self, db_connection, close=False):
+        self.checked_out = False
+
+
+def failing_query(db_connection):
+    raise psycopg2.DataError()
+
+
+async def check_database_run():
+    connection_pool = FakeConnectionPool()
+    db_connection = connection_pool.db_connection
+    db = Database(connection_pool, max_connections=1)
+    assert await db.run(lambda conn, x: (conn, x), 3) == (db_connection, 3)
+    assert db_connection.commits == 1
+    try:
+        await db.run(failing_query)
+    except psycopg2.DataError:
+        pass
+    assert db_connection.rollbacks == 1
+    async with db.transaction() as transaction:
+        await transaction.run(lambda conn: None)
+        await transaction.run(lambda conn: None)
+    assert db_connection.commits == 2
+    assert not connection_pool.checked_out
+    db.executor.shutdown()
+
+
+def test_database_run():
+    asyncio.run(check_database_run())
+
+
+def test_content_type():
+    assert guess_content_type("lupo.png") == "image/png"
+    assert guess_content_type("lupo.notathing") == "binary/octet-stream"
+    assert content_type_is_image("image/gif")
+    assert not content_type_is_image("video/mp4")
+    assert not content_type_is_image(None)
+
+
+def test_random_image_sampler():
+    sampler = RandomImageSampler(
+        [("lupo", "a.png"), ("lupo", "b.png"), ("nao", "c.png")])
+    sampler.add("lupo", "a.png")
+    assert len(sampler) == 3
+    sampler.remove("lupo", "a.png")
+    sampler.remove("lupo", "a.png")
+    assert sorted(sampler.pairs) == [("lupo", "b.png"), ("nao", "c.png")]
+    assert all(sampler.pairs[position] == pair
+               for pair, position in sampler.positions.items())
+    sampler.remove_cmd("lupo")
+    assert sampler.choice() == ("nao", "c.png")
+    sampler.remove("nao", "c.png")
+    assert sampler.choice() is None
+
+
+def test_command_size_counter():
+    counter = CommandSizeCounter({"a": 5, "b": 3, "c": 1}, top_k=2)
+    assert counter.top() == [("a", 5), ("b", 3)]
+    counter.increment("c")
+    assert counter.top_cmds is not None
+    counter.increment("c")
+    counter.increment("c")
+    assert counter.top() == [("a", 5), ("c", 4)]
+    counter.decrement("a")
+    counter.remove_cmd("c")
+    assert counter.top() == [("a", 4), ("b", 3)]
+    assert counter.size("c") == 0
+    counter.decrement("b")
+    counter.decrement("b")
+    counter.decrement("b")
+    assert counter.top() == [("a", 4)]
+    assert "b" not in counter.cmd_sizes
+
+
+def test_group_s3_objects():
+    contents = [
+        {"Key": "pictures/lupo/a.png", "ETag": '"aa"', "Size": 1},
+        {"Key": "pictures/nao/b.gif", "ETag": '"bb"', "Size": 2},
+        {"Key": "pictures/lupo/c.png", "ETag": '"cc"', "Size": 3},
+    ]
+    collection_keys, collection_hashes, collection_sizes = (
+        group_s3_objects(contents))
+    assert collection_keys == {"lupo": ["a.png", "c.png"], "nao": ["b.gif"]}
+    assert collection_hashes == {"lupo": ["aa", "cc"], "nao": ["bb"]}
+    assert collection_sizes == {"lupo": [1, 3], "nao": [2]}
+
+
+def test_diff_s3_manifest():
+    manifest = {
+        "pictures/lupo/a.png": ("aa", 1),
+        "pictures/lupo/b.png": ("bb", 1),
+        "pictures/nao/c.png": ("cc", 1),
+    }
+    contents = [
+        {"Key": "pictures/lupo/a.png", "ETag": '"aa"', "LastModified": 1},
+        {"Key": "pictures/lupo/b.png", "ETag": '"b2"', "LastModified": 2},
+        {"Key": "pictures/nao/d.png", "ETag": '"dd"', "LastModified": 2},
+    ]
+    changed_contents, removed_keys = diff_s3_manifest(manifest, contents)
+    assert [content["Key"] for content in changed_contents] == [
+        "pictures/lupo/b.png", "pictures/nao/d.png"]
+    assert removed_keys == ["pictures/nao/c.png"]
+    # Approved while the listing ran, so the listing may have missed it
+    manifest["pictures/nao/new.png"] = ("nn", 5)
+    changed_contents, removed_keys = diff_s3_manifest(
+        manifest, contents, listing_started=3)
+    assert removed_keys == ["pictures/nao/c.png"]
+
+
+def test_get_prefix():
+    bot = types.SimpleNamespace(user=types.SimpleNamespace(id=1234))
+    prefix_combinations = itertools.product('mMnN', 'bB', '.!', [' ', ''])
+    prefixes = [''.join(r) for r in prefix_combinations]
+    old_prefix = commands.when_mentioned_or(*prefixes)
+    for content in ["mb.help", "Nb! help", "mB.", "mb .help", "mbhelp",
+                    "<@1234> help", "<@!1234>help", "<@999> help",
+                    "hello", "", "m"]:
+        message = types.SimpleNamespace(content=content)
+        old_prefixes = old_prefix(bot, message)
+        old_match = next((prefix for prefix in old_prefixes
+                          if content.startswith(prefix)), None)
+        new_prefixes = get_prefix(bot, message)
+        if isinstance(new_prefixes, str):
+            new_prefixes = [new_prefixes]
+        new_match = next((prefix for prefix in new_prefixes
+                          if content.startswith(prefix)), None)
+        assert new_match == old_match, content
+
+
+async def check_presence_manager():
+    sent_activities = []
+
+    async def change_presence(activity):
+        sent_activities.append(activity)
+
+    presence = PresenceManager(change_presence, min_interval=0.05)
+    presence.request("a")
+    await asyncio.sleep(0)
+    presence.request("b")
+    presence.request("c")
+    presence.request("c")
+    await presence.flush_task
+    presence.request("c")
+    await presence.flush_task
+    assert sent_activities == ["a", "c"]
+    assert presence.num_requested == 5
+    assert presence.num_sent == 2
+    assert presence.num_dropped == 3
+
+
+def test_presence_manager():
+    asyncio.run(check_presence_manager())
+
+
+def test_fair_queue():
+    queue = FairQueue()
+    for job in ["a1", "a2", "a3"]:
+        queue.push("a", job)
+    queue.push("b", "b1")
+    queue.push("c", "c1")
+    queue.push("b", "b2")
+    expected_order = ["a1", "b1", "c1", "a2", "b2", "a3"]
+    assert list(queue.in_order()) == expected_order
+    assert [queue.pop() for _ in range(len(queue))] == expected_order
+
+
+async def check_download_service():
+    downloaded_urls = []
+
+    def download(url):
+        downloaded_urls.append(url)
+        return url.upper()
+
+    downloads = DownloadService(download, num_workers=1)
+    queue_positions = {}
+
+    async def record_position(url, queue_position):
+        queue_positions.setdefault(url, []).append(queue_position)
+
+    def run(uid, url):
+        return downloads.run(uid, url, on_queue_position=functools.partial(
+            record_position, url))
+
+    results = await asyncio.gather(
+        run("a", "a1"), run("a", "a2"), run("a", "a3"), run("b", "b1"))
+    downloads.close()
+    await asyncio.sleep(0)
+    assert results == ["A1", "A2", "A3", "B1"]
+    assert downloaded_urls == ["a1", "a2", "b1", "a3"]
+    assert "a1" not in queue_positions
+    assert queue_positions["b1"] == [2, 1, 0]
+    assert queue_positions["a3"] == [2, 3, 2, 1, 0]
+
+
+def test_download_service():
+    asyncio.run(check_download_service())
+
+
+async def check_transcode_scheduler():
+    transcoder = TranscodeScheduler(max_concurrency=1)
+    returncode, output, _ = await transcoder.run(
+        [sys.executable, "-c", "print('hi')"])
+    assert (returncode, output.strip()) == (0, b"hi")
+    try:
+        await transcoder.run(
+            [sys.executable, "-c", "import time; time.sleep(10)"],
+            timeout=0.5)
+    except asyncio.TimeoutError:
+        pass
+    else:
+        assert False, "Should've timed out"
+    assert transcoder.num_finished == 1
+    assert transcoder.num_failed == 1
+    assert transcoder.num_running == transcoder.num_waiting == 0
+
+
+def test_transcode_scheduler():
+    asyncio.run(check_transcode_scheduler())
+
+
+def test_plan_conversion():
+    probe_output = json.dumps({
+        "format": {"format_name": "matroska,webm", "duration": "12.5",
+                   "size": "300000"},
+        "streams": [{"codec_type": "video", "codec_name": "h264",
+                     "disposition": {"attached_pic": 0}},
+                    {"codec_type": "audio", "codec_name": "aac",
+                     "disposition": {"attached_pic": 0}}]})
+    media_info = parse_media_info(probe_output)
+    assert media_info["duration"] == 12.5
+    assert media_info["video_codec"] == "h264"
+    assert plan_conversion(media_info, "clip.mkv") == ("remux", ".mp4")
+    assert plan_conversion(media_info, "clip.mkv.webm") == ("remux", ".mp4")
+    assert plan_conversion(media_info, "clip.mp4") == ("remux", ".mp4")
+    mp4_info = {**media_info, "format_name": "mov,mp4,m4a,3gp,3g2,mj2"}
+    assert plan_conversion(mp4_info, "clip.mp4") == ("passthrough", None)
+    webm_info = {**media_info, "video_codec": "vp9", "audio_codec": "opus"}
+    assert plan_conversion(webm_info, "clip.mkv.webm") == (
+        "passthrough", None)
+    assert plan_conversion(webm_info, "clip.mp4") == ("remux", ".webm")
+    assert plan_conversion(
+        {**media_info, "size": 10 ** 8}, "clip.mp4") == ("encode", None)
+    assert plan_conversion(
+        {**media_info, "video_codec": "hevc"}, "clip.mp4") == ("encode", None)
+    image_info = parse_media_info(json.dumps({
+        "format": {"format_name": "png_pipe", "duration": "N/A"},
+        "streams": [{"codec_type": "video", "codec_name": "png"}]}))
+    try:
+        plan_conversion(image_info, "image.png")
+    except NotVideo:
+        pass
+    else:
+        assert False, "Images aren't videos"
+
+
+def test_choose_encoding():
+    media_info = {"duration": 10, "video_codec": "h264", "audio_codec": "aac",
+                  "width": 1920, "height": 1080, "fps": 60}
+    encoding = choose_encoding(media_info)
+    assert (encoding["height"], encoding["fps"]) == (1080, 30)
+    assert encoding["predicted_size"] == 4e6
+    encoding = choose_encoding({**media_info, "duration": 30})
+    assert (encoding["height"], encoding["fps"]) == (480, 30)
+    encoding = choose_encoding({**media_info, "duration": 30, "height": 360,
+                                "width": 640, "fps": 24})
+    assert (encoding["height"], encoding["fps"]) == (360, 24)
+    try:
+        choose_encoding({**media_info, "duration": 3600})
+    except QualityTooLow:
+        pass
+    else:
+        assert False, "An hour can't fit"
+
+
+def test_optimize_still_image(tmp_path):
+    original_path = str(tmp_path / "big.png")
+    image = Image.frombytes("RGB", (4000, 2000), os.urandom(4000 * 2000 * 3))
+    image.save(original_path, "PNG")
+    variant_path = optimize_still_image(original_path)
+    with Image.open(variant_path) as variant:
+        assert variant.format == "PNG"
+        assert variant.size == (MAX_VARIANT_DIMENSION,
+                                MAX_VARIANT_DIMENSION // 2)
+
+    small_path = str(tmp_path / "small.png")
+    Image.new("RGB", (10, 10)).save(small_path, "PNG", optimize=True)
+    assert optimize_still_image(small_path) is None
+
+    animated_path = str(tmp_path / "animated.gif")
+    frames = [Image.new("P", (10, 10), color) for color in (0, 1)]
+    frames[0].save(animated_path, save_all=True, append_images=frames[1:])
+    assert optimize_still_image(animated_path) is None
+
+
+def test_bk_tree():
+    hashes = {("cat", f"{i}.png"): i * 0x0101010101010101
+              for i in range(50)}
+    tree = BKTree((cmd, key, phash) for (cmd, key), phash in hashes.items())
+    tree.add(("dog", "copy.png"), hashes[("cat", "7.png")])
+    for phash in [0, 0xFFFFFFFFFFFFFFFF, 0x123456789ABCDEF0]:
+        for max_distance in [0, 3, 10, 20]:
+            expected = sorted(
+                (hamming_distance(phash, item_hash), item)
+                for item, item_hash in [*hashes.items(), (
+                    ("dog", "copy.png"), hashes[("cat", "7.png")])]
+                if hamming_distance(phash, item_hash) <= max_distance)
+            assert tree.search(phash, max_distance) == expected
+    target = hashes[("cat", "7.png")] ^ 0b101
+    assert tree.search(target, 2) == [
+        (2, ("cat", "7.png")), (2, ("dog", "copy.png"))]
+    assert tree.search(target, 2, cmd="dog") == [(2, ("dog", "copy.png"))]
+    tree.remove(("cat", "7.png"))
+    tree.remove_cmd("dog")
+    assert tree.search(target, 2) == []
+    assert len(tree) == 49
+    assert phash_from_db(phash_to_db(0xFFFFFFFFFFFFFFFF)) == (
+        0xFFFFFFFFFFFFFFFF)
+
+
+def test_dhash_image(tmp_path):
+    original_path = str(tmp_path / "original.png")
+    gradient = Image.linear_gradient("L").rotate(30).resize((640, 480))
+    gradient.convert("RGB").save(original_path, "PNG")
+    resized_path = str(tmp_path / "resized.jpg")
+    gradient.resize((160, 120)).save(resized_path, "JPEG", quality=60)
+    other_path = str(tmp_path / "other.png")
+    gradient.transpose(Image.FLIP_LEFT_RIGHT).save(other_path, "PNG")
+    original_hash = dhash_image(original_path)
+    assert hamming_distance(original_hash, dhash_image(resized_path)) <= 4
+    assert hamming_distance(original_hash, dhash_image(other_path)) > 20
+    not_image_path = str(tmp_path / "video.mp4")
+    with open(not_image_path, "wb") as f:
+        f.write(b"not an image")
+    assert dhash_image(not_image_path) is None